@@ -18,11 +18,28 @@
 # TODO:.. filetags -a "mytag" -m "my message" FILES...
 
 import errno
+import hashlib
+import heapq
 import inspect
+import json
+import mmap
 import os
+import pickle
 import re
+import shutil
+import sqlite3
+import stat
+import struct
 import sys
+import tempfile
+import threading
+import time
+import unicodedata
+from bisect import bisect_left
+from collections import Counter, deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import suppress
+from datetime import datetime
 from enum import Enum
 from pathlib import Path
 
@@ -34,6 +51,12 @@ from colr import (
     Colr as C,
 )
 
+try:
+    # Only needed for --backend baloo.
+    import lmdb
+except ImportError:
+    lmdb = None
+
 colr_auto_disable()
 
 NAME = 'File Tags'
@@ -45,20 +68,65 @@ SCRIPTDIR = os.path.abspath(sys.path[0])
 USAGESTR = """{versionstr}
     Usage:
         {script} -h | -v
-        {script} [-A | -c | -t] (FILE... | [-R]) [-i]
-                 [-l] [-D | -F] [-I | -q] [-N]
-        {script} -a tag (FILE... | [-R])
-                 [-l] [-D | -F] [-I | -q] [-N]
-        {script} -d tag (FILE... | [-R])
-                 [-l] [-D | -F] [-I | -q] [-N]
-        {script} -m comment (FILE... | [-R])
-                 [-l] [-D | -F] [-I | -q] [-N]
-        {script} -C [-c] (FILE... | [-R])
-                 [-l] [-D | -F] [-I | -q] [-N]
-        {script} -s pat [-c] [-n] [-r] [-R]
-                 [-l] [-D | -F] [-I | -q] [-N]
-        {script} -s pat [-c]  FILE... [-n] [-r]
-                 [-l] [-D | -F] [-I | -q] [-N]
+        {script} [-A | -c | -t] (FILE... | [-R]) [-i] [-e] [-H]
+                 [--changed-since when]
+                 [-l] [--resolve mode] [--store name] [--on-unsupported how]
+                 [--sort by] [--progress] [--metrics-file file]
+                 [-D | -F] [-I | -q] [-N]
+        {script} -a tag (FILE... | [-R]) [-H] [-y] [--unicode form]
+                 [-l] [--resolve mode] [--store name] [--on-unsupported how]
+                 [--sort by] [--progress] [--metrics-file file]
+                 [-D | -F] [-I | -q] [-N]
+        {script} -d tag (FILE... | [-R]) [-H] [-y] [--unicode form]
+                 [-l] [--resolve mode] [--store name] [--on-unsupported how]
+                 [--sort by] [--progress] [--metrics-file file]
+                 [-D | -F] [-I | -q] [-N]
+        {script} -m comment (FILE... | [-R]) [-H]
+                 [-l] [--resolve mode] [--store name] [--on-unsupported how]
+                 [--sort by] [--progress] [--metrics-file file]
+                 [-D | -F] [-I | -q] [-N]
+        {script} --rename spec [-T] [--aliases file] (FILE... | [-R]) [-H]
+                 [-l] [--resolve mode] [--store name] [--on-unsupported how]
+                 [--sort by] [--progress] [--metrics-file file]
+                 [-D | -F] [-I | -q] [-N]
+        {script} -T [--aliases file] (FILE... | [-R]) [-H]
+                 [-l] [--resolve mode] [--store name] [--on-unsupported how]
+                 [--sort by] [--progress] [--metrics-file file]
+                 [-D | -F] [-I | -q] [-N]
+        {script} -C [-c] (FILE... | [-R]) [-H]
+                 [-l] [--resolve mode] [--store name] [--on-unsupported how]
+                 [--sort by] [--progress] [--metrics-file file]
+                 [-D | -F] [-I | -q] [-N]
+        {script} (-s pat | --tag-list file) [-c] [-n] [-r] [-R] [-P] [-e]
+                 [-H] [--first | -L n] [--backend name] [-y] [--unicode form]
+                 [--cache | --no-cache] [--changed-since when]
+                 [-l] [--resolve mode] [--store name] [--on-unsupported how]
+                 [--sort by] [--progress] [--metrics-file file]
+                 [-D | -F] [-I | -q] [-N]
+        {script} (-s pat | --tag-list file) [-c]  FILE... [-n] [-r] [-H]
+                 [--first | -L n] [-y] [--unicode form] [--cache | --no-cache]
+                 [-l] [--resolve mode] [--store name] [--on-unsupported how]
+                 [--sort by] [--progress] [--metrics-file file]
+                 [-D | -F] [-I | -q] [-N]
+        {script} -U [--store name] [-I | -q] [-N]
+        {script} --clear-cache [-I | -q] [-N]
+        {script} --list-vocabulary [-n] [-I | -q] [-N]
+        {script} --refresh-vocabulary [-l] [--resolve mode] [--store name]
+                 [-I | -q] [-N]
+        {script} --completion shell
+        {script} -S file (FILE... | [-R]) [-H]
+                 [-l] [--resolve mode] [--store name] [--on-unsupported how]
+                 [--sort by] [--progress] [--metrics-file file]
+                 [-D | -F] [-I | -q] [-N]
+        {script} -X file (-s pat | --tag-list file) [-c] [-n] [-r]
+                 [--first | -L n] [-y] [--unicode form]
+                 [-I | -q] [-N]
+        {script} --diff SRC DST [-R] [-j n]
+                 [--progress] [--metrics-file file]
+                 [-l] [--resolve mode] [--store name] [-I | -q] [-N]
+        {script} --sync-from SRC [-R] [-j n]
+                 [--progress] [--metrics-file file]
+                 [-l] [--resolve mode] [--store name] [-I | -q] [-N]
 
     Options:
         FILE                     : One or more file names.
@@ -70,9 +138,45 @@ USAGESTR = """{versionstr}
                                    Files and directories can be filtered
                                    with -F and -D.
         MSG                      : New comment message when setting comments.
+        SRC                      : Source directory for --diff and
+                                   --sync-from.
+        DST                      : Destination directory for --diff.
         -a tag,--add tag         : Add a tag to existing tags.
                                    Several comma-separated tags can be used.
+        --aliases file           : File with one old=new tag rename per line,
+                                   used with --rename and -T.
         -A,--attrs               : List all extended attributes.
+        --backend name           : Where to find files for a tag search.
+                                   Must be one of:
+                                     walk  : Walk the directory.
+                                     baloo : Look up tags in KDE Baloo's
+                                             index, and only read the
+                                             matching files.
+                                             Needs the lmdb module.
+                                             The index is found in
+                                             $FILETAGS_BALOO_INDEX, or
+                                             $XDG_DATA_HOME/baloo/index.
+                                   [default: walk]
+        --cache                  : Cache search results for each directory,
+                                   and only read files that changed since
+                                   the last search. This is the default
+                                   when $FILETAGS_CACHE is set to 1.
+        --clear-cache            : Remove all cached search results, and
+                                   other caches.
+        --changed-since when     : Only use walked paths with a ctime (the
+                                   last tag, comment, or file change) after
+                                   `when`, which is a Unix timestamp, a
+                                   date like 2017-01-31 or
+                                   2017-01-31T14:30:00, or @file.
+                                   For @file, the timestamp is read from
+                                   file and replaced with the start time of
+                                   this run when it finishes without
+                                   errors. When the file doesn't exist
+                                   yet, all paths are used. @file can't be
+                                   used with --first, -L, or -q searches.
+        --completion shell       : Print a completion script for bash or
+                                   zsh, which completes tags from the
+                                   vocabulary for all refreshed trees.
         -c,--comment             : List file comments,
                                    search comments when -s is used,
                                    clear comments when -C is used.
@@ -80,42 +184,387 @@ USAGESTR = """{versionstr}
                                    or comments when -c is used.
         -d tag,--delete tag      : Remove an existing tag.
                                    Several comma-separated tags can be used.
+        --diff                   : Show tag and comment differences
+                                   between the SRC and DST directories,
+                                   matching paths by their relative path.
+                                   The exit code is 1 when they differ.
         -D,--dirs                : Use directories only.
+        -e,--emptycache          : Remember files with no tags or comment,
+                                   and skip them in searches, or when -i is
+                                   used, until they change.
+                                   The cache is kept for each directory that
+                                   filetags is run from.
         -F,--files               : Use files only.
+        --first                  : Stop searching after the first match.
+                                   This is the same as -L 1.
         -h,--help                : Show this help message.
+        -H,--hardlinks           : Read and write each file once, even when
+                                   it has several names (hard links, or
+                                   symlinks). Every name is still printed.
         -i,--noblanks            : Omit files that are missing attrs, tags,
                                    or comments when -A, -c, or -t is used.
         -I,--debug               : Print debugging info.
+        -j n,--jobs n            : Number of files to read at once, when
+                                   using --diff or --sync-from.
+                                   [default: 8]
         -l,--symlinks            : Follow symlinks.
+        -L n,--limit n           : Stop searching after n matches.
+                                   When -q is used, searches stop after the
+                                   first match, because only the exit code
+                                   matters.
         -m msg,--setcomment msg  : Set the comment for a file.
+        --list-vocabulary        : List all tags used in the current
+                                   directory tree, and how many files have
+                                   them, from the vocabulary cache.
+                                   With -n, only tags are listed.
+        --metrics-file file      : Write counters and extended attribute
+                                   call latencies to a file, in Prometheus
+                                   text format, every 10 seconds.
         -n,--names               : Print names only when searching.
+        --no-cache               : Don't use cached search results, even
+                                   when $FILETAGS_CACHE is set.
         -N,--nocolor             : Don't colorize output.
                                    This is automatically enabled when piping
                                    output.
+        --on-unsupported how     : What to do with paths on file systems
+                                   that don't support extended attributes,
+                                   when no file names are given.
+                                   Each file system is only checked once.
+                                   Must be one of:
+                                     error   : Print an error for each path.
+                                     skip    : Skip them silently.
+                                     summary : Skip them, and print a count
+                                               for each file system.
+                                   [default: error]
+        -P,--prune               : Skip sub-directories when searching tags
+                                   if their rollup shows that no tag below
+                                   them can match. See -U.
+        --progress               : Print progress to stderr (files scanned,
+                                   matched, written, errors, files per
+                                   second, and time left when known).
         -q,--quiet               : Don't print anything to stdout.
                                    Error messages are still printed to stderr.
                                    This affects all commands, including the
                                    list commands.
+        --refresh-vocabulary     : Rebuild the vocabulary cache for the
+                                   current directory tree. It is updated
+                                   when tags are set with this tool, but
+                                   not by other programs.
         -r,--reverse             : Show files that don't match the search.
         -R,--recurse             : Recurse all sub-directories and files.
+        --rename spec            : Rename tags, where spec is old=new.
+                                   Several comma-separated renames can be
+                                   used. Renaming to an existing tag merges
+                                   them, and old= removes the tag.
+        --resolve mode           : How to resolve file paths.
+                                   Must be one of:
+                                     always        : Resolve all symlinks.
+                                     never         : Use absolute paths,
+                                                     without resolving.
+                                     symlinks-only : Only resolve paths that
+                                                     are symlinks.
+                                   [default: always]
         -s pat,--search pat      : Search for text/regex pattern in tags,
                                    or comments when -c is used.
+                                   If pat starts with @, the rest is a
+                                   pattern file (see --tag-list).
+                                   The exit code is 1 when nothing matches.
+        --sort by                : Sort paths before using them.
+                                   Must be one of:
+                                     path  : Sort by path. When walking
+                                             directories, each directory is
+                                             sorted, and followed by its
+                                             contents.
+                                     tags  : Sort by tags, then path.
+                                     mtime : Sort by modification time,
+                                             then path.
+        -S file,--snapshot file  : Save tags and comments for all paths to a
+                                   snapshot file, for searching with -X.
+        --store name             : Where tags and comments are stored.
+                                   Must be one of:
+                                     xattr   : Extended attributes.
+                                     sidecar : A .filetags.db file in the
+                                               current directory, or the
+                                               closest parent directory
+                                               that has one.
+                                     mirror  : Read from the sidecar file,
+                                               falling back to extended
+                                               attributes. Write to both,
+                                               unless extended attributes
+                                               are not supported.
+                                   [default: xattr]
+        --sync-from SRC          : Copy tags and comments from the SRC
+                                   directory to matching paths in the
+                                   current directory, only writing the
+                                   ones that differ.
         -t,--tags                : List all tags.
+        --tag-list file          : Search for any of the patterns in a file,
+                                   one per line, in a single pass.
+                                   Blank lines and lines starting with #
+                                   are ignored. Patterns matching exact
+                                   tags (^tag$), prefixes (^tag), suffixes
+                                   (tag$), or text (tag) are matched
+                                   without regexes. The matching patterns
+                                   are listed for each file.
+        -T,--normalize           : Normalize tags, making them lowercase
+                                   and removing extra whitespace.
+        --unicode form           : Normalize unicode when searching, and
+                                   when adding or removing tags, so
+                                   composed and decomposed characters are
+                                   the same. Must be one of:
+                                   NFC, NFD, NFKC, NFKD
+        -U,--rollup              : Build tag rollups for every directory in
+                                   the current directory tree.
+                                   Rollups are kept up to date when tags are
+                                   set with this tool, but must be rebuilt
+                                   when other programs change tags.
         -v,--version             : Show version.
+        -X file,--from-snapshot file
+                                 : Search a snapshot file made with -S,
+                                   instead of the file system.
+        -y,--ignorecase          : Ignore case when searching, and when
+                                   adding or removing tags (Python and
+                                   python are the same tag).
 
     The default action when no flag arguments are present is to list all tags.
     When no file names are given, files and directories in the current
     directory are used. When -R is given, the current directory is recursed.
 """.format(script=SCRIPT, versionstr=VERSIONSTR)
 
+# Completion scripts for --completion, formatted with:
+#   script  : Script name.
+#   func    : Script name, usable as a shell function name.
+#   options : All options, separated by spaces.
+#   vocabfile : Name of the vocabulary file in CACHEDIR.
+COMPLETIONS = {
+    'bash': """# bash completion for {script}, add this to ~/.bashrc:
+#   eval "$({script} --completion bash)"
+_{func}_tags() {{
+    # Read the vocabulary file directly, starting python is too slow.
+    local vocab="${{XDG_CACHE_HOME:-$HOME/.cache}}/filetags/{vocabfile}"
+    if [[ -r "$vocab" ]]; then
+        printf '%s\\n' "$(<"$vocab")"
+        return 0
+    fi
+    # Building the vocabulary reads every file, so only suggest it.
+    printf '\\nNo tag vocabulary yet, use: {script} --refresh-vocabulary\\n' \\
+        >&2
+}}
+_{func}() {{
+    local cur prev prefix word
+    cur="${{COMP_WORDS[COMP_CWORD]}}"
+    prev="${{COMP_WORDS[COMP_CWORD-1]}}"
+    case "$prev" in
+        -a|--add|-d|--delete|-s|--search)
+            # Several comma-separated tags can be used.
+            prefix=""
+            word="$cur"
+            if [[ "$cur" == *,* ]]; then
+                prefix="${{cur%,*}},"
+                word="${{cur##*,}}"
+            fi
+            local IFS=$'\\n'
+            COMPREPLY=($(compgen -P "$prefix" -W "$(_{func}_tags)" -- "$word"))
+            return 0
+            ;;
+    esac
+    if [[ "$cur" == -* ]]; then
+        COMPREPLY=($(compgen -W "{options}" -- "$cur"))
+        return 0
+    fi
+    COMPREPLY=($(compgen -f -- "$cur"))
+}}
+complete -o filenames -F _{func} {script}
+""",
+    'zsh': """# zsh completion for {script}, add this to ~/.zshrc
+# (after compinit):
+#   eval "$({script} --completion zsh)"
+_{func}_tags() {{
+    # Read the vocabulary file directly, starting python is too slow.
+    local vocab="${{XDG_CACHE_HOME:-$HOME/.cache}}/filetags/{vocabfile}"
+    local -a tags
+    if [[ ! -r "$vocab" ]]; then
+        # Building the vocabulary reads every file, so only suggest it.
+        _message 'No tag vocabulary yet, use: {script} --refresh-vocabulary'
+        return 1
+    fi
+    tags=("${{(@f)$(<"$vocab")}}")
+    compadd -a tags
+}}
+_{func}() {{
+    case "${{words[CURRENT-1]}}" in
+        -a|--add|-d|--delete|-s|--search)
+            # Several comma-separated tags can be used.
+            compset -P '*,'
+            _{func}_tags
+            return
+            ;;
+    esac
+    if [[ "$PREFIX" == -* ]]; then
+        compadd -- {options}
+    else
+        _files
+    fi
+}}
+compdef _{func} {script}
+""",
+}
+
 # Global debug flag, set with --debug to print messages.
 DEBUG = False
 # Global silence flag, set with --quiet to avoid non-error messages.
 QUIET = False
+# Global Metrics, set with --progress or --metrics-file.
+METRICS = None
+# Global count of errors printed with print_err().
+ERRCNT = 0
+# Result for each path from iter_records(). `error` is an exception when
+# reading the file or running the operation failed, and `result` is the
+# operation's return value.
+Record = namedtuple('Record', ('path', 'tags', 'comment', 'error', 'result'))
+# Directory for persistent caches.
+CACHEDIR = os.path.join(
+    os.environ.get('XDG_CACHE_HOME', None) or os.path.expanduser('~/.cache'),
+    'filetags')
 
 
 def main(argd):
     """ Main entry point, expects doctopt arg dict as argd. """
+    # These need to be fast, for shell completion.
+    if argd['--completion']:
+        return print_completion(argd['--completion'])
+    if argd['--list-vocabulary']:
+        return list_vocabulary(os.getcwd(), names_only=argd['--names'])
+    Editor.follow_symlinks = argd['--symlinks']
+    try:
+        Editor.resolver = PathResolver(argd['--resolve'] or 'always')
+        Editor.store = get_store(argd['--store'] or 'xattr', os.getcwd())
+    except (EnvironmentError, ValueError) as ex:
+        print_err(ex)
+        return 1
+
+    try:
+        Editor.set_folding(
+            ignorecase=argd['--ignorecase'],
+            form=argd['--unicode'])
+    except ValueError as ex:
+        print_err(ex)
+        return 1
+    if argd['--tag-list']:
+        argd['--search'] = '@{}'.format(argd['--tag-list'])
+    if argd['--search']:
+        argd['--search'] = try_repat(argd['--search'])
+        if argd['--search'] is None:
+            return 1
+    try:
+        argd['--limit'] = parse_limit(argd)
+        if argd['--sort'] not in (None, 'path', 'tags', 'mtime'):
+            raise ValueError(
+                'Invalid sort, expecting one of: path, tags, mtime')
+        if argd['--backend'] not in (None, 'walk', 'baloo'):
+            raise ValueError('Invalid backend, expecting one of: walk, baloo')
+        if argd['--backend'] == 'baloo':
+            if argd['--comment'] or argd['--reverse']:
+                raise ValueError(
+                    'The baloo backend only supports normal tag searches.')
+            if argd['--search'].search('') is not None:
+                raise ValueError(
+                    'The baloo backend can\'t find untagged files, '
+                    'the pattern must not match an empty string.')
+    except ValueError as ex:
+        print_err(ex)
+        return 1
+
+    support = None
+    if argd['--on-unsupported'] not in (None, 'error'):
+        if argd['--on-unsupported'] not in ('skip', 'summary'):
+            print_err(
+                'Invalid --on-unsupported, expecting: error, skip, summary')
+            return 1
+        support = SupportCache()
+    try:
+        changed = ChangedSince.from_arg(argd['--changed-since'])
+    except (EnvironmentError, ValueError) as ex:
+        print_err(ex)
+        return 1
+    if (changed is not None) and changed.statefile and argd['--limit']:
+        # The walk stops early, so unseen changes would be skipped next time.
+        print_err(
+            '--changed-since @file can\'t be used with --first, -L, or -q '
+            'searches.')
+        return 1
+    if argd['--hardlinks']:
+        Editor.inode_cache = InodeCache()
+    Editor.vocabulary = Vocabulary()
+    if argd['--emptycache']:
+        if isinstance(Editor.store, XattrStore):
+            Editor.empty_cache = EmptyCache(os.getcwd())
+        else:
+            # Sidecar writes don't change the ctime of a file.
+            debug('The empty file cache only works with --store xattr.')
+    argd['--cache'] = use_search_cache(argd)
+    if (METRICS is not None) and METRICS.filepath:
+        Editor.store = TimedStore(Editor.store, METRICS)
+    try:
+        if argd['--clear-cache']:
+            return clear_cache()
+        if argd['--rollup']:
+            return build_rollups(os.getcwd())
+        if argd['--refresh-vocabulary']:
+            return refresh_vocabulary(os.getcwd())
+        if argd['--diff'] or argd['--sync-from']:
+            try:
+                jobs = max(int(argd['--jobs'] or 1), 1)
+            except ValueError:
+                print_err('Invalid number of jobs: {}'.format(argd['--jobs']))
+                return 1
+            if argd['--diff']:
+                return diff_trees(
+                    argd['SRC'],
+                    argd['DST'],
+                    recurse=argd['--recurse'],
+                    jobs=jobs)
+            return sync_trees(
+                argd['--sync-from'],
+                os.getcwd(),
+                recurse=argd['--recurse'],
+                jobs=jobs)
+        if argd['--from-snapshot']:
+            return search_snapshot(
+                argd['--from-snapshot'],
+                argd['--search'],
+                comments=argd['--comment'],
+                names_only=argd['--names'],
+                reverse=argd['--reverse'],
+                limit=argd['--limit'])
+        errcnt = ERRCNT
+        ret = run_action(argd, support=support, changed=changed)
+        if changed is not None:
+            # Paths that failed must be used again next time.
+            changed.save(complete=ERRCNT == errcnt)
+        return ret
+    finally:
+        if (support is not None) and (argd['--on-unsupported'] == 'summary'):
+            support.print_summary()
+        if Editor.empty_cache is not None:
+            Editor.empty_cache.save()
+        try:
+            Editor.vocabulary.save()
+        except EnvironmentError as ex:
+            print_err('Unable to update the tag vocabulary.', ex)
+        Editor.store.close()
+        if METRICS is not None:
+            METRICS.finish()
+
+
+def run_action(argd, support=None, changed=None):
+    """ Gather file names, and run the action requested in docopt's arg dict.
+        If a SupportCache is given for `support`, walked paths on file
+        systems without extended attribute support are skipped.
+        If a ChangedSince is given for `changed`, walked paths that haven't
+        changed since its timestamp are skipped.
+        Returns an exit status code.
+    """
     pathfilter = PathFilter.from_argd(argd)
     filenames = parse_filenames(
         argd['FILE'],
@@ -123,25 +572,81 @@ def main(argd):
     )
     if filenames:
         print(format_file_cnt('path', len(filenames), label='Using'))
+        if METRICS is not None:
+            METRICS.total = len(filenames)
+    elif filenames is None and argd['--backend'] == 'baloo':
+        filenames = get_baloo_filenames(
+            argd['--search'],
+            recurse=argd['--recurse'],
+            pathfilter=pathfilter)
+        if filenames is None:
+            return 1
     elif filenames is None:
+        prunes = []
+        if support is not None:
+            prunes.append(support.is_unsupported_dir)
+        if argd['--search'] and argd['--prune']:
+            pruner = rollup_pruner(
+                argd['--search'],
+                comments=argd['--comment'],
+                reverse=argd['--reverse'])
+            if pruner is not None:
+                prunes.append(pruner)
+        prune = None
+        if prunes:
+            def prune(dirpath):
+                return any(func(dirpath) for func in prunes)
+        skips = []
+        if changed is not None:
+            skips.append(changed.is_unchanged)
+        if support is not None:
+            skips.append(support.is_unsupported)
+        if (Editor.empty_cache is not None) and skips_empty(argd):
+            skips.append(Editor.empty_cache.is_empty)
+        skip = None
+        if skips:
+            def skip(entry):
+                return any(func(entry) for func in skips)
         filenames = get_filenames(
             recurse=argd['--recurse'],
-            pathfilter=pathfilter)
+            pathfilter=pathfilter,
+            prune=prune,
+            skip=skip,
+            sort=bool(argd['--sort']))
+        if argd['--sort'] == 'path':
+            # Already sorted while walking.
+            argd['--sort'] = None
     else:
         # User passed arguments, and none were valid.
         print_err('No paths to work with!')
         return 1
 
-    Editor.follow_symlinks = argd['--symlinks']
+    if argd['--sort']:
+        filenames = sort_filenames(filenames, argd['--sort'])
 
     if argd['--search']:
-        return search(
-            comments=argd['--comment'],
-            filenames=filenames,
-            pattern=argd['--search'],
-            names_only=argd['--names'],
-            reverse=argd['--reverse']
-        )
+        cache = None
+        if argd['--cache']:
+            try:
+                cache = SearchCache(
+                    argd['--search'],
+                    comments=argd['--comment'],
+                    reverse=argd['--reverse'])
+            except EnvironmentError as ex:
+                print_err('Not using the search cache.', ex)
+        try:
+            return search(
+                comments=argd['--comment'],
+                filenames=filenames,
+                pattern=argd['--search'],
+                names_only=argd['--names'],
+                reverse=argd['--reverse'],
+                limit=argd['--limit'],
+                cache=cache,
+            )
+        finally:
+            if cache is not None:
+                cache.close()
 
     if argd['--add']:
         return add_tag(filenames, argd['--add'])
@@ -157,6 +662,14 @@ def main(argd):
         return remove_tag(filenames, argd['--delete'])
     elif argd['--setcomment']:
         return set_comment(filenames, argd['--setcomment'])
+    elif argd['--snapshot']:
+        return write_snapshot(filenames, argd['--snapshot'])
+    elif argd['--rename'] or argd['--normalize']:
+        return rename_tag(
+            filenames,
+            argd['--rename'],
+            aliasfile=argd['--aliases'],
+            normalize=argd['--normalize'])
     elif argd['--tags']:
         return list_tags(filenames, ignore_empty=argd['--noblanks'])
 
@@ -176,8 +689,8 @@ def add_tag(filenames, tagstr):
         return 1
 
     for filename in filenames:
-        editor = Editor(filename)
         try:
+            editor = Editor(filename)
             settags = editor.add_tags(tags)
         except Editor.AttrError as ex:
             print_err(ex)
@@ -191,6 +704,98 @@ def add_tag(filenames, tagstr):
     return errs
 
 
+def build_rollups(root):
+    """ Walk `root` from the bottom up, storing a count of the tags found
+        below each directory in that directory's rollup attribute.
+        Directories that can't be fully read get no rollup, so they are
+        never pruned from a search.
+        Returns the number of errors.
+    """
+    errs = 0
+    # Tag counts for finished sub-directories, until their parent is done.
+    subcounts = {}
+
+    def walk_error(ex):
+        nonlocal errs
+        print_err('Unable to walk directory: {}'.format(ex.filename), ex)
+        errs += 1
+
+    cnt = 0
+    for dirpath, dirs, files in os.walk(
+            root, topdown=False, onerror=walk_error):
+        counts = Counter()
+        complete = True
+        for dirname in dirs:
+            subpath = os.path.join(dirpath, dirname)
+            if os.path.islink(subpath):
+                # Symlinked directories are not walked, only their tags count.
+                continue
+            subcount = subcounts.pop(subpath, None)
+            if subcount is None:
+                complete = False
+            else:
+                counts.update(subcount)
+        for name in dirs + files:
+            try:
+                editor = Editor(os.path.join(dirpath, name))
+            except (Editor.AttrError, FileNotFoundError) as ex:
+                print_err(ex)
+                errs += 1
+                complete = False
+                continue
+            counts.update(editor.tags)
+        if not complete:
+            debug('Incomplete rollup for: {}'.format(dirpath))
+            remove_rollup(dirpath)
+            continue
+        subcounts[dirpath] = counts
+        try:
+            if not set_rollup(dirpath, counts):
+                # Too large, this directory is never pruned.
+                continue
+        except EnvironmentError as ex:
+            print_err('Unable to set rollup for: {}'.format(dirpath), ex)
+            errs += 1
+            remove_rollup(dirpath)
+            continue
+        cnt += 1
+    status(format_file_cnt('rollup', cnt, label='Set'))
+    return errs
+
+
+def cache_path(name, root=None):
+    """ Return a file path in CACHEDIR, creating CACHEDIR if needed.
+        If `root` is given, the file name is made unique for that directory.
+    """
+    os.makedirs(CACHEDIR, exist_ok=True)
+    if root:
+        digest = hashlib.md5(root.encode(errors='surrogateescape'))
+        name = '{}-{}'.format(digest.hexdigest(), name)
+    return os.path.join(CACHEDIR, name)
+
+
+def clear_cache():
+    """ Remove all files (and directories) in CACHEDIR.
+        Returns the number of errors.
+    """
+    errs = 0
+    cnt = 0
+    with suppress(FileNotFoundError):
+        for entry in os.scandir(CACHEDIR):
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    shutil.rmtree(entry.path)
+                else:
+                    os.remove(entry.path)
+            except EnvironmentError as ex:
+                print_err('Unable to remove cache file.', ex)
+                errs += 1
+            else:
+                cnt += 1
+    status(format_file_cnt('cache file', cnt, label='Removed'))
+    return errs
+
+
 def clear_comment(filenames):
     """ Clear all comments from file names.
         Return the number of errors.
@@ -219,8 +824,8 @@ def clear_xattr(filenames, attrname=None):
     attrtype = attrname.split('.')[-1]
     errs = 0
     for filename in filenames:
-        editor = Editor(filename)
         try:
+            editor = Editor(filename)
             editor.remove_attr(attrname)
         except Editor.AttrError as ex:
             print_err(ex)
@@ -234,6 +839,46 @@ def clear_xattr(filenames, attrname=None):
     return errs
 
 
+def close_filenames(filenames):
+    """ Close a file name generator (from get_filenames()) early, so no
+        more directories are walked. Other iterables are left alone.
+    """
+    close = getattr(filenames, 'close', None)
+    if close is not None:
+        close()
+
+
+def compare_trees(srcroot, dstroot, recurse=False, jobs=1):
+    """ Walk two directory trees in lockstep, yielding
+        (srcpath, dstpath, srceditor, dsteditor) for each relative path.
+        Paths that are missing from one tree have None for the path and
+        editor. When reading fails, the AttrError is yielded in place of
+        the source editor, with None for the destination editor.
+        Up to `jobs` files are read at once.
+        Possibly raises EnvironmentError if either root can't be listed.
+    """
+    def read_pair(paths):
+        srcpath, dstpath = paths
+        try:
+            srceditor = Editor(srcpath) if srcpath else None
+            dsteditor = Editor(dstpath) if dstpath else None
+        except Editor.AttrError as ex:
+            return paths, ex
+        return paths, (srceditor, dsteditor)
+
+    pairs = iter_tree_pairs(
+        os.path.realpath(srcroot),
+        os.path.realpath(dstroot),
+        recurse=recurse)
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        for (srcpath, dstpath), result in map_bounded(
+                read_pair, pairs, executor, window=jobs * 4):
+            if isinstance(result, Editor.AttrError):
+                yield srcpath, dstpath, result, None
+                continue
+            yield (srcpath, dstpath) + result
+
+
 def debug(*args, **kwargs):
     """ Print a message only if DEBUG is truthy. """
     if not (DEBUG and args):
@@ -290,6 +935,81 @@ def debug(*args, **kwargs):
     return status(msg, **kwargs)
 
 
+def diff_trees(srcroot, dstroot, recurse=False, jobs=1):
+    """ Print tag and comment differences between two directory trees.
+        Returns 1 if the trees differ, or can't be compared, otherwise 0.
+    """
+    diffcnt = 0
+    errs = 0
+    try:
+        for srcpath, dstpath, src, dst in compare_trees(
+                srcroot, dstroot, recurse=recurse, jobs=jobs):
+            if isinstance(src, Editor.AttrError):
+                print_err(src)
+                errs += 1
+                continue
+            if dstpath is None:
+                status(format_file_name(srcpath, label='Only in source:'))
+                diffcnt += 1
+                continue
+            if srcpath is None:
+                status(format_file_name(dstpath, label='Only in destination:'))
+                diffcnt += 1
+                continue
+            diffs = format_diffs(src, dst)
+            if diffs:
+                status('{}\n    {}'.format(
+                    format_file_name(dst.filepath, label='Differs:'),
+                    diffs))
+                diffcnt += 1
+    except EnvironmentError as ex:
+        print_err('Unable to compare directories.', ex)
+        return 1
+    status('\n{}'.format(format_file_cnt('difference', diffcnt)))
+    return int(bool(diffcnt or errs))
+
+
+def external_sort(iterable, key, chunksize=100000):
+    """ Yield items from an iterable, sorted by key(item), then item.
+        At most `chunksize` items are held in memory. Larger inputs are
+        sorted in chunks that are spilled to temporary files, and merged.
+    """
+    runs = []
+    chunk = []
+    try:
+        for item in iterable:
+            chunk.append((key(item), item))
+            if len(chunk) >= chunksize:
+                chunk.sort()
+                runs.append(spill_run(chunk))
+                chunk = []
+        chunk.sort()
+        if runs:
+            debug('Merging {} sorted runs.'.format(len(runs) + 1))
+        merged = heapq.merge(iter(chunk), *(read_run(f) for f in runs))
+        for _, item in merged:
+            yield item
+    finally:
+        for f in runs:
+            f.close()
+
+
+def format_diffs(src, dst):
+    """ Return formatted tag and comment differences between two Editors,
+        or '' if they are the same.
+    """
+    diffs = []
+    if src.tags != dst.tags:
+        diffs.append('   tags: {} -> {}'.format(
+            C(Editor.tag_sep.join(dst.tags), fore='red'),
+            C(Editor.tag_sep.join(src.tags), fore='green')))
+    if src.comment != dst.comment:
+        diffs.append('comment: {} -> {}'.format(
+            C(repr(dst.comment), fore='red'),
+            C(repr(src.comment), fore='green')))
+    return '\n    '.join(diffs)
+
+
 def format_file_attrs(filename, attrvals):
     """ Return a formatted file name and attribute name/values dict
         as str.
@@ -306,32 +1026,36 @@ def format_file_attrs(filename, attrvals):
         vals)
 
 
-def format_file_comment(filename, comment, label=None):
+def format_file_comment(filename, comment, label=None, isdir=None):
     """ Return a formatted file name and comment. """
     if not comment:
         comment = str(
             C('empty', fore='red').join('(', ')', style='bright')
         )
     return '{}:\n    {}'.format(
-        format_file_name(filename, label=label),
+        format_file_name(filename, label=label, isdir=isdir),
         '\n    '.join(l for l in comment.splitlines())
     )
 
 
-def format_file_name(filename, label=None):
-    """ Return a formatted file name string. """
-    style = 'bright' if os.path.isdir(filename) else 'normal'
+def format_file_name(filename, label=None, isdir=None):
+    """ Return a formatted file name string.
+        If `isdir` is None, the file system is checked for directories.
+    """
+    if isdir is None:
+        isdir = os.path.isdir(filename)
+    style = 'bright' if isdir else 'normal'
     return ''.join((
         '{} '.format(label) if label else '',
         str(C(filename, fore='blue', style=style))
     ))
 
 
-def format_file_tags(filename, taglist, label=None):
+def format_file_tags(filename, taglist, label=None, isdir=None):
     """ Return a formatted file name and tags. """
 
     return '{}:\n    {}'.format(
-        format_file_name(filename, label=label),
+        format_file_name(filename, label=label, isdir=isdir),
         format_tags(taglist)
     )
 
@@ -350,6 +1074,13 @@ def format_file_cnt(filetype, total, label='Found'):
     )
 
 
+def format_matched(patterns):
+    """ Format a list of matching patterns, for PatternSet searches. """
+    return '    {} {}'.format(
+        C('matched:', fore='blue'),
+        C(', ').join(C(s, fore='yellow') for s in patterns))
+
+
 def format_tags(taglist):
     """ Format a list of tags into an indented string. """
     tags = '\n    '.join(str(C(s, fore='cyan')) for s in taglist)
@@ -358,9 +1089,60 @@ def format_tags(taglist):
     return tags
 
 
-def get_filenames(recurse=False, pathfilter=None):
+def get_baloo_filenames(repat, recurse=False, pathfilter=None):
+    """ Return a sorted list of paths in the current directory with tags
+        matching `repat`, according to Baloo's index. Only the matching
+        files are touched, to skip stale entries and apply `pathfilter`.
+        If recurse is True, paths in sub-directories are included.
+        Returns None on errors.
+    """
+    pathfilter = pathfilter or PathFilter.none
+    cwd = os.getcwd()
+    # Baloo stores real paths, but they are reported relative to cwd.
+    realcwd = os.path.realpath(cwd)
+    try:
+        with BalooIndex() as index:
+            debug('Searching Baloo index: {}'.format(index.filepath))
+            paths = index.search_tags(repat)
+    except BalooIndex.errors as ex:
+        print_err('Unable to read the Baloo index.', ex)
+        return None
+    filenames = []
+    for path in paths:
+        relpath = os.path.relpath(path, realcwd)
+        outside = (relpath == os.pardir) or relpath.startswith(
+            os.pardir + os.sep)
+        if outside or relpath == os.curdir:
+            continue
+        if not (recurse or os.sep not in relpath):
+            continue
+        filepath = os.path.join(cwd, relpath)
+        try:
+            isdir = stat.S_ISDIR(os.lstat(filepath).st_mode)
+        except EnvironmentError:
+            # Removed since it was indexed.
+            debug('Skipping missing path: {}'.format(filepath))
+            continue
+        if pathfilter != PathFilter.none:
+            if isdir != (pathfilter == PathFilter.dirs):
+                continue
+        filenames.append(filepath)
+    filenames.sort()
+    status('\n{}'.format(format_file_cnt('indexed file', len(filenames))))
+    return filenames
+
+
+def get_filenames(
+        recurse=False, pathfilter=None, prune=None, skip=None, sort=False):
     """ Yield file paths in the current directory.
         If recurse is True, walk the current directory yielding paths.
+        If `prune` is given, it is called with each directory path while
+        walking. Directories are still yielded, but not walked, when it
+        returns True.
+        If `skip` is given, it is called with the os.DirEntry for each path,
+        and the path is not yielded when it returns True.
+        If `sort` is True, each directory is sorted by name, and each
+        sub-directory is followed by its contents.
     """
     pathfilter = pathfilter or PathFilter.none
 
@@ -370,38 +1152,177 @@ def get_filenames(recurse=False, pathfilter=None):
         '              Filtering: {}'
     )).format(cwd, pathfilter))
 
+    if sort:
+        yield from get_sorted_filenames(
+            cwd,
+            recurse=recurse,
+            pathfilter=pathfilter,
+            prune=prune,
+            skip=skip)
+        return None
+
+    # Without recursion, -F only uses regular files (and links to them).
+    isfile_only = (pathfilter == PathFilter.files) and not recurse
     cnt = 0
-    if recurse:
-        try:
-            for root, dirs, files in os.walk(cwd):
-                if pathfilter != PathFilter.files:
-                    for dirname in dirs:
+    try:
+        for root, dirs, files in walk_entries(cwd):
+            # Walked directories never contain symlinks.
+            Editor.resolver.add_dir(root)
+            if pathfilter != PathFilter.files:
+                for entry in dirs:
+                    if skip is None or not skip(entry):
                         cnt += 1
-                        yield os.path.join(root, dirname)
-                if pathfilter != PathFilter.dirs:
-                    for filename in files:
+                        yield entry.path
+            if pathfilter != PathFilter.dirs:
+                for entry in files:
+                    if isfile_only and not entry.is_file():
+                        # Broken symlinks, or special files.
+                        continue
+                    if skip is None or not skip(entry):
                         cnt += 1
-                        yield os.path.join(root, filename)
-        except EnvironmentError as ex:
-            print_err('Unable to walk directory: {}'.format(cwd), ex)
-    else:
-        filterpath = {
-            PathFilter.none: lambda s: True,
-            PathFilter.dirs: os.path.isdir,
-            PathFilter.files: os.path.isfile
-        }.get(pathfilter)
+                        yield entry.path
+            if not recurse:
+                break
+            if prune is not None:
+                dirs[:] = [d for d in dirs if not prune(d.path)]
+    except EnvironmentError as ex:
+        print_err('Unable to list directory: {}'.format(cwd), ex)
+    status('\n{}'.format(format_file_cnt('file', cnt)))
 
-        try:
-            for path in os.listdir(cwd):
-                fullpath = os.path.join(cwd, path)
-                if filterpath(fullpath):
-                    cnt += 1
-                    yield fullpath
-        except EnvironmentError as ex:
-            print_err('Unable to list directory: {}'.format(cwd), ex)
+
+def get_sorted_filenames(
+        top, recurse=False, pathfilter=None, prune=None, skip=None):
+    """ Yield sorted file paths in `top`, for get_filenames(sort=True).
+        Each directory is yielded right before its contents, so the output
+        is sorted by path components.
+    """
+    # Without recursion, -F only uses regular files (and links to them).
+    isfile_only = (pathfilter == PathFilter.files) and not recurse
+    cnt = 0
+    try:
+        for entry, isdir in walk_sorted(top, recurse=recurse, prune=prune):
+            if isdir:
+                if pathfilter == PathFilter.files:
+                    continue
+            elif pathfilter == PathFilter.dirs:
+                continue
+            elif isfile_only and not entry.is_file():
+                # Broken symlinks, or special files.
+                continue
+            if skip is None or not skip(entry):
+                cnt += 1
+                yield entry.path
+    except EnvironmentError as ex:
+        print_err('Unable to list directory: {}'.format(top), ex)
     status('\n{}'.format(format_file_cnt('file', cnt)))
 
 
+def get_rollup(dirpath):
+    """ Return the rollup Counter for a directory, or None if it has no
+        rollup.
+        Possibly raises EnvironmentError.
+    """
+    try:
+        rollup = Editor.store.getxattr(dirpath, Editor.attr_rollup)
+    except EnvironmentError as ex:
+        if ex.errno == Editor.errno_nodata:
+            return None
+        raise
+    try:
+        return Counter(json.loads(rollup.decode()))
+    except ValueError as ex:
+        debug('Invalid rollup for: {}'.format(dirpath), ex=ex)
+        return None
+
+
+def get_store(name, root):
+    """ Return an attribute store instance by name ('xattr', 'sidecar',
+        or 'mirror'). Sidecar stores use the closest `.filetags.db` to
+        `root`, or create one in `root`.
+        Raises ValueError for unknown names.
+        Possibly raises EnvironmentError when opening a sidecar file.
+    """
+    if name == 'xattr':
+        return XattrStore()
+    storetype = {
+        'sidecar': SidecarStore,
+        'mirror': MirrorStore,
+    }.get(name, None)
+    if storetype is None:
+        raise ValueError(
+            'Invalid store, expecting one of: xattr, sidecar, mirror')
+    return storetype(SidecarStore.find_root(root))
+
+
+def iter_tree_pairs(srcroot, dstroot, recurse=False):
+    """ Yield (srcpath, dstpath) for paths in two directory trees, walked
+        in lockstep and matched by relative path. Paths missing from one
+        tree are None.
+        Possibly raises EnvironmentError if either root can't be listed.
+    """
+    def relpaths(root):
+        for entry, _ in walk_sorted(root, recurse=recurse):
+            yield os.path.relpath(entry.path, root).split(os.sep), entry.path
+
+    srcpaths, dstpaths = relpaths(srcroot), relpaths(dstroot)
+    src, dst = next(srcpaths, None), next(dstpaths, None)
+    while (src is not None) or (dst is not None):
+        if (dst is None) or ((src is not None) and (src[0] < dst[0])):
+            yield src[1], None
+            src = next(srcpaths, None)
+        elif (src is None) or (dst[0] < src[0]):
+            yield None, dst[1]
+            dst = next(dstpaths, None)
+        else:
+            yield src[1], dst[1]
+            src, dst = next(srcpaths, None), next(dstpaths, None)
+
+
+def iter_records(paths, operation=None, *args, executor=None, window=16):
+    """ Return an iterator of Records for each path in `paths`, in order,
+        without printing anything. This is the library interface for
+        batches of files.
+        `operation` may be the name of an Editor method (like 'add_tags',
+        'remove_tags', 'set_comment', or 'match_tags'), or a function that
+        accepts an Editor. It is called with `args` for each file, and the
+        Record has the tags and comment after it runs.
+        If `executor` (a concurrent.futures executor) is given, files are
+        handled concurrently, with at most `window` of them pending.
+        Directory rollups and the vocabulary are updated under a lock, so
+        operations that write tags are safe to run concurrently.
+        Only `window` records are held at once, so `paths` can be a lazy
+        iterable of any length.
+        Raises ValueError if `operation` is not a public Editor method name.
+    """
+    if isinstance(operation, str):
+        if operation.startswith('_') or not callable(
+                getattr(Editor, operation, None)):
+            raise ValueError('Not an Editor method: {}'.format(operation))
+        methodname = operation
+
+        def operation(editor, *args):
+            return getattr(editor, methodname)(*args)
+
+    def read_record(path):
+        try:
+            editor = Editor(path)
+            result = None
+            if operation is not None:
+                result = operation(editor, *args)
+        except (EnvironmentError, ValueError) as ex:
+            return Record(str(path), [], '', ex, None)
+        return Record(
+            editor.filepath,
+            list(editor.tags),
+            editor.comment,
+            None,
+            result)
+
+    if executor is None:
+        return map(read_record, paths)
+    return map_bounded(read_record, paths, executor, window=window)
+
+
 def list_action(filenames, value_func_name, format_func, ignore_empty=False):
     """ Run an action for the 'list' commands.
         Arguments:
@@ -416,10 +1337,9 @@ def list_action(filenames, value_func_name, format_func, ignore_empty=False):
     """
     errs = 0
     for filename in filenames:
-        editor = Editor(filename)
-        value_func = getattr(editor, value_func_name)
         try:
-            values = value_func()
+            editor = Editor(filename)
+            values = getattr(editor, value_func_name)()
         except Editor.AttrError as ex:
             print_err(ex)
             errs += 1
@@ -463,6 +1383,67 @@ def list_tags(filenames, ignore_empty=False):
         ignore_empty=ignore_empty)
 
 
+def list_vocabulary(dirpath, names_only=False):
+    """ Print tags used in the tree at `dirpath`, most common first, from
+        the vocabulary cache.
+        Returns 1 if there is no vocabulary for the tree, otherwise 0.
+    """
+    try:
+        counts = Vocabulary().get_counts(dirpath)
+    except EnvironmentError as ex:
+        print_err(ex)
+        return 1
+    if counts is None:
+        if not names_only:
+            print_err('No vocabulary for this directory, use: {} {}'.format(
+                SCRIPT,
+                '--refresh-vocabulary'))
+        return 1
+    for tag, cnt in counts:
+        if names_only:
+            status(tag)
+        else:
+            status('{:>8} {}'.format(C(cnt, fore='blue'), C(tag, fore='cyan')))
+    return 0
+
+
+def map_bounded(func, iterable, executor, window=16):
+    """ Yield func(item) for each item, in order, running the calls with a
+        concurrent.futures executor. At most `window` calls are pending at
+        once, so long iterables are not loaded into memory.
+    """
+    pending = deque()
+    try:
+        for item in iterable:
+            pending.append(executor.submit(func, item))
+            if len(pending) >= window:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+def parse_aliases(filepath):
+    """ Parse a tag alias file into a dict of {old: new}.
+        Each line is an old=new rename. Blank lines and lines starting with
+        # are ignored.
+        Possibly raises EnvironmentError or ValueError.
+    """
+    renames = {}
+    with open(filepath, 'r') as f:
+        for linenum, line in enumerate(f, start=1):
+            line = line.strip()
+            if (not line) or line.startswith('#'):
+                continue
+            try:
+                renames.update(parse_renames(line, single=True))
+            except ValueError as ex:
+                raise ValueError('{}:{}: {}'.format(filepath, linenum, ex))
+    return renames
+
+
 def parse_filenames(filenames, pathfilter=None, nostdin=False):
     """ Ensure all file names have an absolute path.
         Print any non-existent files.
@@ -506,6 +1487,47 @@ def parse_filenames(filenames, pathfilter=None, nostdin=False):
     return validnames
 
 
+def parse_limit(argd):
+    """ Return the maximum number of search results from docopt's arg dict,
+        or None for no limit.
+        When QUIET is set, only the exit code matters, so searches can stop
+        after the first match.
+        Raises ValueError for invalid limits.
+    """
+    if argd['--first']:
+        return 1
+    if argd['--limit']:
+        try:
+            limit = int(argd['--limit'])
+        except ValueError:
+            limit = 0
+        if limit < 1:
+            raise ValueError(
+                'Invalid limit, expecting a number above 0: {}'.format(
+                    argd['--limit']))
+        return limit
+    if QUIET and argd['--search']:
+        return 1
+    return None
+
+
+def parse_renames(spec, single=False):
+    """ Parse a rename spec ('old=new,old2=new2') into a dict of
+        {old: new}. If `single` is truthy, `spec` is a single rename that
+        may contain Editor.tag_sep.
+        Raises ValueError for invalid renames.
+    """
+    renames = {}
+    for rename in ([spec] if single else spec.split(Editor.tag_sep)):
+        old, eq, new = rename.partition('=')
+        old, new = old.strip(), new.strip()
+        if not (eq and old):
+            raise ValueError('Invalid rename, expecting old=new: {}'.format(
+                rename))
+        renames[old] = new
+    return renames
+
+
 def parse_stdin_filenames():
     """ Read file names from stdin. One file name per line. """
     if sys.stdin.isatty() and sys.stdout.isatty():
@@ -517,10 +1539,39 @@ def parse_stdin_filenames():
     )
 
 
-def print_err(msg=None, ex=None):
+def print_completion(shell):
+    """ Print a completion script for `shell` (bash or zsh).
+        Returns 1 for unknown shells, otherwise 0.
+    """
+    script = COMPLETIONS.get(shell, None)
+    if script is None:
+        print_err('Invalid shell, expecting one of: {}'.format(
+            ', '.join(sorted(COMPLETIONS))))
+        return 1
+    options = sorted(set(re.findall(
+        r'(?<![\w-])(--?[a-zA-Z][\w-]*)',
+        USAGESTR.split('Options:')[1])))
+    print(script.format(
+        script=SCRIPT,
+        func=re.sub(r'\W', '_', SCRIPT),
+        options=' '.join(options),
+        vocabfile=Vocabulary.textfilename))
+    return 0
+
+
+def print_err(msg=None, ex=None, count=True):
     """ Print an error message.
         If an Exception is passed in for `ex`, it's message is also printed.
+        If `count` is False, the message is only a notice (printed to
+        stderr), and is not counted as an error.
     """
+    global ERRCNT
+    if count:
+        ERRCNT += 1
+    if METRICS is not None:
+        if count:
+            METRICS.count('errors')
+        METRICS.clear_progress()
     if msg:
         if isinstance(msg, Exception):
             # Shortcut use, like print_err(ex=msg).
@@ -538,14 +1589,47 @@ def print_err(msg=None, ex=None):
     return None
 
 
+def read_run(f):
+    """ Yield pickled items from a sorted run file made by spill_run(). """
+    while True:
+        try:
+            yield pickle.load(f)
+        except EOFError:
+            break
+
+
+def refresh_vocabulary(root):
+    """ Rebuild the vocabulary cache for the tree at `root`, by reading
+        the tags for every path in it.
+        Returns the number of errors.
+    """
+    counts = Counter()
+    errs = 0
+    for filename in get_filenames(recurse=True):
+        try:
+            editor = Editor(filename)
+        except Editor.AttrError as ex:
+            print_err(ex)
+            errs += 1
+            continue
+        counts.update(set(editor.tags))
+    try:
+        Vocabulary().refresh(root, counts)
+    except EnvironmentError as ex:
+        print_err(ex)
+        return errs + 1
+    status(format_file_cnt('tag', len(counts), label='Saved'))
+    return errs
+
+
 def remove_comment(filenames):
     """ Remove the comment from file names.
         Returns the number of errors.
     """
     errs = 0
     for filename in filenames:
-        editor = Editor(filename)
         try:
+            editor = Editor(filename)
             editor.clear_comment()
         except Editor.AttrError as ex:
             print_err(ex)
@@ -557,6 +1641,17 @@ def remove_comment(filenames):
     return errs
 
 
+def remove_rollup(dirpath):
+    """ Remove the rollup for a directory, ignoring all errors.
+        Missing rollups only disable pruning, so this is always safe.
+    """
+    try:
+        Editor.store.removexattr(dirpath, Editor.attr_rollup)
+    except EnvironmentError as ex:
+        if ex.errno != Editor.errno_nodata:
+            debug('Unable to remove rollup for: {}'.format(dirpath), ex=ex)
+
+
 def remove_tag(filenames, tagstr):
     """ Remove a tag or tags from file names.
         Returns the number of errors.
@@ -569,8 +1664,8 @@ def remove_tag(filenames, tagstr):
         return 1
 
     for filename in filenames:
-        editor = Editor(filename)
         try:
+            editor = Editor(filename)
             finaltags = editor.remove_tags(taglist)
         except Editor.AttrError as ex:
             print_err(ex)
@@ -581,31 +1676,107 @@ def remove_tag(filenames, tagstr):
     return errs
 
 
+def rename_tag(filenames, spec, aliasfile=None, normalize=False):
+    """ Rename tags for file names, using a rename spec ('old=new,...'),
+        and/or an alias file. Tags are normalized first if `normalize` is
+        truthy. Files are only written when their tags change.
+        Returns the number of errors.
+    """
+    renames = {}
+    try:
+        if aliasfile:
+            renames.update(parse_aliases(aliasfile))
+        if spec:
+            renames.update(parse_renames(spec))
+    except (EnvironmentError, ValueError) as ex:
+        print_err(ex)
+        return 1
+    if normalize:
+        renames = {
+            Editor.normalize_tag(old): Editor.normalize_tag(new)
+            for old, new in renames.items()
+        }
+    debug('Renames: {!r}'.format(renames))
+
+    errs = 0
+    cnt = 0
+    for filename in filenames:
+        try:
+            editor = Editor(filename)
+            oldtags = list(editor.tags)
+            newtags = editor.rename_tags(renames, normalize=normalize)
+        except Editor.AttrError as ex:
+            print_err(ex)
+            errs += 1
+            continue
+        if newtags == oldtags:
+            continue
+        cnt += 1
+        status(format_file_tags(
+            editor.filepath,
+            newtags,
+            label='Set tags for'))
+    status('\n{}'.format(format_file_cnt('file', cnt, label='Changed')))
+    return errs
+
+
+def rollup_pruner(repat, comments=False, reverse=False):
+    """ Return a function for get_filenames(prune=...) that skips directories
+        when their rollup shows that no tag below them matches `repat`,
+        a compiled regex or PatternSet.
+        Returns None when rollups can't be used for the search:
+            Comment searches and reverse searches.
+            Patterns that match untagged files (by matching '').
+    """
+    if comments or reverse:
+        debug('Rollups are only used for normal tag searches.')
+        return None
+    if repat.search('') is not None:
+        return None
+
+    def prune(dirpath):
+        try:
+            counts = get_rollup(dirpath)
+        except EnvironmentError:
+            return False
+        if counts is None:
+            return False
+        if any(
+                repat.search(Editor.fold_key(tag)) is not None
+                for tag in counts):
+            return False
+        debug('Pruning: {}'.format(dirpath))
+        return True
+    return prune
+
+
 def search(
         comments=False, filenames=None, pattern=None,
-        names_only=False, reverse=False):
+        names_only=False, reverse=False, limit=None, cache=None):
     """ Run one of the search functions on comments/tags.
+        `pattern` is a compiled regex or PatternSet, from try_repat().
         If no file names are given, the current directory is used.
         If recurse is True, the current directory is walked.
     """
-    pat = try_repat(pattern)
-    if pat is None:
-        return 1
-
     searchargs = {
         'names_only': names_only,
-        'reverse': reverse
+        'reverse': reverse,
+        'limit': limit,
+        'cache': cache,
     }
     debug('search args: {!r}'.format(searchargs))
     if comments:
-        return search_comments(filenames, pat, **searchargs)
-    return search_tags(filenames, pat, **searchargs)
+        return search_comments(filenames, pattern, **searchargs)
+    return search_tags(filenames, pattern, **searchargs)
 
 
 def search_comments(
-        filenames, repat, names_only=False, reverse=False):
+        filenames, repat, names_only=False, reverse=False, limit=None,
+        cache=None):
     """ Search comments for a pattern.
-        Returns the number of errors.
+        If `limit` is set, stop after that many matches.
+        If a SearchCache is given for `cache`, unchanged files are not read.
+        Returns the number of errors, or 1 if nothing matched.
     """
     debug('Running comment search for: {}'.format(repat.pattern))
     found = 0
@@ -614,32 +1785,103 @@ def search_comments(
         debug('Using reverse match.')
 
     for filename in filenames:
-        editor = Editor(filename)
-        try:
-            comment = editor.match_comment(repat, reverse=reverse)
-        except Editor.AttrError as ex:
-            print_err(ex)
-            errs += 1
-            continue
+        cached = None if cache is None else cache.get(filename)
+        if cached is not None:
+            filepath, comment = cached
+        else:
+            try:
+                editor = Editor(filename)
+                comment = editor.match_comment(repat, reverse=reverse)
+            except Editor.AttrError as ex:
+                print_err(ex)
+                errs += 1
+                continue
+            filepath = editor.filepath
+            if cache is not None:
+                cache.set(filename, filepath, comment)
 
         if comment is not None:
             if names_only:
-                status(format_file_name(editor.filepath))
+                status(format_file_name(filepath))
             else:
-                status(format_file_comment(editor.filepath, comment))
+                status(format_file_comment(filepath, comment))
+                if isinstance(repat, PatternSet) and not reverse:
+                    status(format_matched(
+                        repat.which([Editor.fold_key(comment, cache=False)])))
             found += 1
+            if METRICS is not None:
+                METRICS.count('matched')
+            if found == limit:
+                debug('Search limit reached: {}'.format(limit))
+                close_filenames(filenames)
+                break
 
     if not names_only:
         status('\n{}'.format(format_file_cnt('comment', found)))
-    return errs
+    return errs or int(not found)
+
+
+def search_snapshot(
+        filepath, repat, comments=False, names_only=False, reverse=False,
+        limit=None):
+    """ Search tags or comments in a snapshot file, without reading any
+        other files.
+        `repat` is a compiled regex or PatternSet, from try_repat().
+        If `limit` is set, stop after that many matches.
+        Returns 1 for errors or no matches, otherwise 0.
+    """
+    try:
+        snapshot = Snapshot(filepath)
+    except (EnvironmentError, ValueError) as ex:
+        print_err('Unable to open snapshot: {}'.format(filepath), ex)
+        return 1
+    debug('Searching snapshot with {} files, {} tags: {}'.format(
+        snapshot.file_cnt,
+        snapshot.tag_cnt,
+        filepath))
+    if comments:
+        matches = snapshot.search_comments(repat, reverse=reverse)
+        formatter = format_file_comment
+        filetype = 'comment'
+    else:
+        matches = snapshot.search_tags(repat, reverse=reverse)
+        formatter = format_file_tags
+        filetype = 'tag'
+    found = 0
+    with snapshot:
+        try:
+            for path, isdir, value in matches:
+                found += 1
+                if METRICS is not None:
+                    METRICS.count('matched')
+                if names_only:
+                    status(format_file_name(path, isdir=isdir))
+                else:
+                    status(formatter(path, value, isdir=isdir))
+                    if isinstance(repat, PatternSet) and not reverse:
+                        values = [value] if comments else value
+                        status(format_matched(repat.which(
+                            Editor.fold_key(v, cache=not comments)
+                            for v in values)))
+                if found == limit:
+                    break
+        except ValueError as ex:
+            print_err('Unable to read snapshot: {}'.format(filepath), ex)
+            return 1
+    if not names_only:
+        status('\n{}'.format(format_file_cnt(filetype, found)))
+    return int(not found)
 
 
 def search_tags(
-        filenames, repat, names_only=False, reverse=False):
-    """ Search comments for a pattern.
+        filenames, repat, names_only=False, reverse=False, limit=None,
+        cache=None):
+    """ Search tags for a pattern.
         If no file names are given, the current directory is used.
         If recurse is True, the current directory is walked.
-        Returns the number of errors.
+        If `limit` is set, stop after that many matches.
+        If a SearchCache is given for `cache`, unchanged files are not read.
+        Returns the number of errors, or 1 if nothing matched.
     """
     debug('Running tag search for: {}'.format(repat.pattern))
 
@@ -647,24 +1889,40 @@ def search_tags(
     errs = 0
 
     for filename in filenames:
-        editor = Editor(filename)
-        try:
-            tags = editor.match_tags(repat, reverse=reverse)
-        except Editor.AttrError as ex:
-            print_err(ex)
-            errs += 1
-            continue
+        cached = None if cache is None else cache.get(filename)
+        if cached is not None:
+            filepath, tags = cached
+        else:
+            try:
+                editor = Editor(filename)
+                tags = editor.match_tags(repat, reverse=reverse)
+            except Editor.AttrError as ex:
+                print_err(ex)
+                errs += 1
+                continue
+            filepath = editor.filepath
+            if cache is not None:
+                cache.set(filename, filepath, tags)
 
         if tags is not None:
             found += 1
+            if METRICS is not None:
+                METRICS.count('matched')
             if names_only:
-                status(format_file_name(editor.filepath))
+                status(format_file_name(filepath))
             else:
-                status(format_file_tags(editor.filepath, tags))
+                status(format_file_tags(filepath, tags))
+                if isinstance(repat, PatternSet) and not reverse:
+                    status(format_matched(
+                        repat.which(Editor.fold_key(t) for t in tags)))
+            if found == limit:
+                debug('Search limit reached: {}'.format(limit))
+                close_filenames(filenames)
+                break
 
     if not names_only:
         status('\n{}'.format(format_file_cnt('tag', found)))
-    return errs
+    return errs or int(not found)
 
 
 def set_comment(filenames, comment):
@@ -673,8 +1931,8 @@ def set_comment(filenames, comment):
     """
     errs = 0
     for filename in filenames:
-        editor = Editor(filename)
         try:
+            editor = Editor(filename)
             newcomment = editor.set_comment(comment)
         except Editor.AttrError as ex:
             errs += 1
@@ -688,28 +1946,470 @@ def set_comment(filenames, comment):
     return errs
 
 
+def set_rollup(dirpath, counts):
+    """ Set the rollup for a directory from a Counter of {tag: count}.
+        Returns False, and removes any old rollup, when the rollup is
+        larger than Editor.rollup_max_size. Otherwise returns True.
+        Possibly raises EnvironmentError.
+    """
+    rollup = {tag: cnt for tag, cnt in counts.items() if cnt > 0}
+    value = json.dumps(rollup, separators=(',', ':')).encode(Editor.encoding)
+    if len(value) > Editor.rollup_max_size:
+        debug('Rollup is too large ({} bytes) for: {}'.format(
+            len(value),
+            dirpath))
+        remove_rollup(dirpath)
+        return False
+    Editor.store.setxattr(dirpath, Editor.attr_rollup, value)
+    return True
+
+
+def skips_empty(argd):
+    """ Return True if files with no tags and no comment can't show up in
+        the output for docopt's arg dict, so they can be skipped.
+    """
+    if argd['--search']:
+        if argd['--reverse']:
+            return False
+        # Empty tags/comments are tested against ''.
+        return argd['--search'].search('') is None
+    # Blank files are omitted when listing tags/comments, but a file can
+    # still have other attributes.
+    return argd['--noblanks'] and not argd['--attrs']
+
+
+def sort_filenames(filenames, sortby):
+    """ Return a generator of file names sorted by 'path', 'tags', or
+        'mtime'. Ties are sorted by path.
+        Memory use is bounded, see external_sort().
+    """
+    def pathkey(filename):
+        return filename.split(os.sep)
+
+    def tagkey(filename):
+        # Only the tags are read, the action builds the Editor later.
+        try:
+            tags = Editor.parse_tagstr(Editor.store.getxattr(
+                Editor.resolver.resolve(filename),
+                Editor.attr_tags,
+                symlink=Editor.follow_symlinks))
+        except (EnvironmentError, UnicodeDecodeError):
+            tags = []
+        return tags, pathkey(filename)
+
+    def mtimekey(filename):
+        try:
+            mtime = os.stat(filename).st_mtime_ns
+        except EnvironmentError:
+            mtime = 0
+        return mtime, pathkey(filename)
+
+    key = {
+        'path': pathkey,
+        'tags': tagkey,
+        'mtime': mtimekey,
+    }[sortby]
+    return external_sort(filenames, key)
+
+
+def spill_run(items):
+    """ Pickle sorted items to a temporary file, returning the open file,
+        rewound for read_run().
+    """
+    f = tempfile.TemporaryFile()
+    pickler = pickle.Pickler(f, protocol=pickle.HIGHEST_PROTOCOL)
+    for item in items:
+        pickler.dump(item)
+        # Items are read back one at a time, so don't keep references.
+        pickler.clear_memo()
+    f.seek(0)
+    return f
+
+
 def status(msg, **kwargs):
     """ Print a message, unless QUIET is set (with --quiet).
         kwargs are for print().
     """
     if QUIET:
         return None
+    if METRICS is not None:
+        METRICS.clear_progress()
     return print(msg, **kwargs)
 
 
+def sync_trees(srcroot, dstroot, recurse=False, jobs=1):
+    """ Copy tags and comments from one directory tree to another, for
+        paths that exist in both. Only attributes that differ are written.
+        Returns the number of errors.
+    """
+    errs = 0
+    cnt = 0
+    try:
+        for srcpath, dstpath, src, dst in compare_trees(
+                srcroot, dstroot, recurse=recurse, jobs=jobs):
+            if isinstance(src, Editor.AttrError):
+                print_err(src)
+                errs += 1
+                continue
+            if (srcpath is None) or (dstpath is None):
+                debug('Not in both trees: {}'.format(srcpath or dstpath))
+                continue
+            diffs = format_diffs(src, dst)
+            if not diffs:
+                continue
+            try:
+                if src.tags != dst.tags:
+                    if src.tags:
+                        dst.set_tags(src.tags)
+                    else:
+                        dst.clear_tags()
+                if src.comment != dst.comment:
+                    if src.comment:
+                        dst.set_comment(src.comment)
+                    else:
+                        dst.clear_comment()
+            except Editor.AttrError as ex:
+                print_err(ex)
+                errs += 1
+                continue
+            cnt += 1
+            status('{}\n    {}'.format(
+                format_file_name(dst.filepath, label='Synced'),
+                diffs))
+    except EnvironmentError as ex:
+        print_err('Unable to compare directories.', ex)
+        return errs + 1
+    status('\n{}'.format(format_file_cnt('file', cnt, label='Synced')))
+    return errs
+
+
 def try_repat(s):
     """ Try compiling a regex pattern.
+        If `s` starts with @, the rest is a pattern file for PatternSet.
         On failure, print any errors and return None.
-        Return the compiled regex pattern on success.
+        When Editor.folding is set, the pattern is folded to match folded
+        tags and comments.
+        Return the compiled regex pattern (or PatternSet) on success.
     """
+    fold = Editor.fold_pattern if Editor.folding else None
+    if s.startswith('@'):
+        try:
+            return PatternSet.from_file(s[1:], fold=fold)
+        except EnvironmentError as ex:
+            print_err('Unable to read pattern file: {}'.format(s[1:]), ex)
+        except ValueError as ex:
+            print_err(ex)
+        return None
     try:
-        pat = re.compile(s)
+        pat = re.compile(s if fold is None else fold(s))
     except re.error as ex:
         print_err('Invalid pattern: {}'.format(s), ex)
         return None
     return pat
 
 
+def update_rollups(path, oldtags, newtags):
+    """ Update the rollups for each parent directory of `path` after it's
+        tags changed from `oldtags` to `newtags`.
+        Every parent with a rollup is updated, even above parents without
+        one (like new directories), because a stale rollup would hide
+        matches. Rollups that grow too large, or can't be written, are
+        removed.
+    """
+    oldtags, newtags = set(oldtags), set(newtags)
+    if oldtags == newtags:
+        return None
+    for parent in Path(path).parents:
+        dirpath = str(parent)
+        try:
+            counts = get_rollup(dirpath)
+        except EnvironmentError:
+            counts = None
+        if counts is None:
+            continue
+        counts.update(newtags - oldtags)
+        counts.subtract(oldtags - newtags)
+        try:
+            set_rollup(dirpath, counts)
+        except EnvironmentError as ex:
+            # A stale rollup would hide matches, so it must not be kept.
+            debug('Unable to update rollup for: {}'.format(dirpath), ex=ex)
+            remove_rollup(dirpath)
+    return None
+
+
+def use_search_cache(argd):
+    """ Return True if the search cache should be used for docopt's arg dict.
+        It is used with --cache, or when FILETAGS_CACHE is set (to anything
+        but 0), unless --no-cache is used.
+    """
+    if not argd['--search'] or argd['--no-cache']:
+        return False
+    if not (argd['--cache'] or (
+            os.environ.get('FILETAGS_CACHE', '0') not in ('', '0'))):
+        return False
+    if not isinstance(Editor.store, XattrStore):
+        # Sidecar writes don't change the ctime of a file.
+        debug('The search cache only works with --store xattr.')
+        return False
+    return True
+
+
+def walk_entries(top):
+    """ Walk a directory tree like os.walk(), but yield lists of os.DirEntry
+        for the directories and files instead of names.
+        Directories removed from the list (in-place) are not walked.
+        Raises EnvironmentError if `top` can't be listed. Unreadable
+        sub-directories are skipped.
+    """
+    stack = [top]
+    while stack:
+        dirpath = stack.pop()
+        try:
+            entries = list(os.scandir(dirpath))
+        except EnvironmentError as ex:
+            if dirpath == top:
+                raise
+            debug('Unable to list directory: {}'.format(dirpath), ex=ex)
+            continue
+        dirs, files = [], []
+        for entry in entries:
+            try:
+                isdir = entry.is_dir()
+            except EnvironmentError:
+                isdir = False
+            if isdir:
+                dirs.append(entry)
+            else:
+                files.append(entry)
+        yield dirpath, dirs, files
+        # Symlinked directories are listed, but not walked.
+        stack.extend(
+            entry.path
+            for entry in reversed(dirs)
+            if not entry.is_symlink()
+        )
+
+
+def walk_sorted(top, recurse=True, prune=None):
+    """ Yield (os.DirEntry, isdir) for paths in `top`, sorted by name in each
+        directory, with each walked directory followed by its contents.
+        Directories are not walked when `prune(path)` returns True.
+        Symlinked directories are listed, but not walked.
+        Raises EnvironmentError if `top` can't be listed. Unreadable
+        sub-directories are skipped.
+    """
+    def sorted_entries(dirpath):
+        return iter(sorted(os.scandir(dirpath), key=lambda e: e.name))
+
+    stack = [sorted_entries(top)]
+    while stack:
+        entry = next(stack[-1], None)
+        if entry is None:
+            stack.pop()
+            continue
+        try:
+            isdir = entry.is_dir()
+        except EnvironmentError:
+            isdir = False
+        yield entry, isdir
+        if not (recurse and isdir) or entry.is_symlink():
+            continue
+        if (prune is not None) and prune(entry.path):
+            continue
+        try:
+            stack.append(sorted_entries(entry.path))
+        except EnvironmentError as ex:
+            debug('Unable to list directory: {}'.format(entry.path), ex=ex)
+            continue
+        # Walked directories never contain symlinks.
+        Editor.resolver.add_dir(entry.path)
+
+
+def write_snapshot(filenames, filepath):
+    """ Write tags and comments for file names to a snapshot file.
+        Returns the number of errors.
+    """
+    errs = 0
+    records = []
+    for filename in filenames:
+        try:
+            editor = Editor(filename)
+        except Editor.AttrError as ex:
+            print_err(ex)
+            errs += 1
+            continue
+        records.append((
+            editor.filepath,
+            editor.path.is_dir(),
+            editor.tags,
+            editor.comment,
+        ))
+    try:
+        Snapshot.write(filepath, records)
+    except EnvironmentError as ex:
+        print_err('Unable to write snapshot: {}'.format(filepath), ex)
+        return errs + 1
+    status(format_file_cnt('file', len(records), label='Saved'))
+    return errs
+
+
+class Metrics(object):
+    """ Counters and extended attribute call latencies for a run.
+        Progress is printed to stderr when `progress` is True, and metrics
+        are written to `filepath` in Prometheus text format every
+        `interval` seconds, and when finished.
+        Metrics may be updated from several threads.
+    """
+    counter_names = ('scanned', 'matched', 'written', 'errors')
+    counter_help = {
+        'scanned': 'Files read by filetags.',
+        'matched': 'Files matching a search.',
+        'written': 'Attribute writes and removals.',
+        'errors': 'Errors reported by filetags.',
+    }
+    # Upper bounds for latency histogram buckets, in seconds.
+    buckets = (
+        0.0001, 0.00025, 0.0005,
+        0.001, 0.0025, 0.005,
+        0.01, 0.025, 0.05,
+        0.1, 0.25, 0.5,
+        1, 2.5, 5, 10,
+    )
+    # Minimum seconds between progress updates.
+    progress_interval = 0.2
+
+    def __init__(self, progress=False, filepath=None, interval=10):
+        self.progress = progress
+        self.filepath = filepath
+        self.interval = interval
+        self.counters = Counter()
+        # Total number of files, when known, for estimating time left.
+        self.total = None
+        # op -> [bucket counts..., +Inf count]
+        self.histograms = {}
+        # op -> Sum of seconds.
+        self.sums = Counter()
+        self.start = time.monotonic()
+        self.last_progress = 0
+        self.last_write = self.start
+        self.progress_shown = False
+        # Reentrant, because writing may print errors (clear_progress()).
+        self.lock = threading.RLock()
+
+    def clear_progress(self):
+        """ Clear the progress line, so other messages can be printed. """
+        with self.lock:
+            if self.progress_shown:
+                sys.stderr.write('\r\x1b[K')
+                self.progress_shown = False
+
+    def count(self, name, n=1):
+        """ Increment a counter. """
+        with self.lock:
+            self.counters[name] += n
+            self.update()
+
+    def finish(self):
+        """ Print final progress, and write the final metrics. """
+        self.update(final=True)
+        if self.progress_shown:
+            sys.stderr.write('\n')
+            sys.stderr.flush()
+
+    def format_progress(self):
+        """ Return a progress line. """
+        elapsed = time.monotonic() - self.start
+        rate = self.counters['scanned'] / elapsed if elapsed else 0
+        pieces = [
+            '{}: {}'.format(name, self.counters[name])
+            for name in self.counter_names
+        ]
+        pieces.append('{:.1f} files/s'.format(rate))
+        if self.total and rate:
+            left = max(self.total - self.counters['scanned'], 0) / rate
+            pieces.append('ETA: {}:{:02}'.format(
+                int(left // 60),
+                int(left % 60)))
+        return ', '.join(pieces)
+
+    def format_prometheus(self):
+        """ Return all metrics in Prometheus text format. """
+        lines = []
+        for name in self.counter_names:
+            metric = 'filetags_{}_total'.format(name)
+            lines.extend((
+                '# HELP {} {}'.format(metric, self.counter_help[name]),
+                '# TYPE {} counter'.format(metric),
+                '{} {}'.format(metric, self.counters[name]),
+            ))
+        elapsed = time.monotonic() - self.start
+        lines.extend((
+            '# HELP filetags_run_seconds Seconds since filetags started.',
+            '# TYPE filetags_run_seconds gauge',
+            'filetags_run_seconds {:.3f}'.format(elapsed),
+        ))
+        metric = 'filetags_xattr_call_seconds'
+        lines.extend((
+            '# HELP {} Extended attribute call latency.'.format(metric),
+            '# TYPE {} histogram'.format(metric),
+        ))
+        for op, counts in sorted(self.histograms.items()):
+            total = 0
+            for bound, cnt in zip(self.buckets + ('+Inf', ), counts):
+                total += cnt
+                lines.append('{}_bucket{{op="{}",le="{}"}} {}'.format(
+                    metric,
+                    op,
+                    bound,
+                    total))
+            lines.append('{}_sum{{op="{}"}} {:.6f}'.format(
+                metric,
+                op,
+                self.sums[op]))
+            lines.append('{}_count{{op="{}"}} {}'.format(metric, op, total))
+        return '\n'.join(lines) + '\n'
+
+    def observe(self, op, seconds):
+        """ Record the latency for an extended attribute call. """
+        with self.lock:
+            counts = self.histograms.get(op, None)
+            if counts is None:
+                counts = self.histograms[op] = [0] * (len(self.buckets) + 1)
+            counts[bisect_left(self.buckets, seconds)] += 1
+            self.sums[op] += seconds
+
+    def update(self, final=False):
+        """ Print progress and write metrics, if it is time to. """
+        with self.lock:
+            now = time.monotonic()
+            if self.progress and (
+                    final or
+                    (now - self.last_progress >= self.progress_interval)):
+                self.last_progress = now
+                sys.stderr.write(
+                    '\r\x1b[K{}'.format(self.format_progress()))
+                sys.stderr.flush()
+                self.progress_shown = True
+            if self.filepath and (
+                    final or (now - self.last_write >= self.interval)):
+                self.last_write = now
+                self.write()
+
+    def write(self):
+        """ Write metrics to self.filepath, replacing it atomically so
+            collectors never see a partial file.
+        """
+        tmppath = '{}.tmp'.format(self.filepath)
+        try:
+            with open(tmppath, 'w') as f:
+                f.write(self.format_prometheus())
+            os.replace(tmppath, self.filepath)
+        except EnvironmentError as ex:
+            self.filepath = None
+            print_err('Unable to write metrics file, disabling it.', ex)
+
+
 class PathFilter(Enum):
 
     """ File path filter setting. """
@@ -735,6 +2435,1675 @@ class PathFilter(Enum):
         return cls.none
 
 
+class BalooIndex(object):
+    """ Read-only access to tags in KDE Baloo's LMDB index.
+        Baloo stores a posting list for each term in the `postingdb`
+        database, where whole tags are terms like b'TAG-mytag'. Posting
+        lists are arrays of native 64-bit document ids. The `idfilename`
+        database maps each document id to its parent id and file name,
+        with a parent id of 0 for the top-level path.
+        Use it as a context manager to close the LMDB environment.
+    """
+    tag_prefix = b'TAG-'
+    id_struct = struct.Struct('=Q')
+    # Errors possibly raised when opening or searching the index.
+    errors = (EnvironmentError, ValueError) + (
+        (lmdb.Error, ) if lmdb is not None else ())
+
+    def __init__(self, filepath=None):
+        if lmdb is None:
+            raise ValueError(
+                'The lmdb module is needed for Baloo: pip install lmdb')
+        self.filepath = filepath or self.default_path()
+        # Raises lmdb.Error if missing, or when it isn't an LMDB file.
+        self.env = lmdb.open(
+            self.filepath,
+            subdir=False,
+            readonly=True,
+            max_dbs=16)
+        self.postingdb = self.env.open_db(b'postingdb', create=False)
+        self.idfilename = self.env.open_db(b'idfilename', create=False)
+        # Document id -> path, for directories shared between results.
+        self.paths = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exctype, excvalue, tb):
+        self.close()
+        return False
+
+    def close(self):
+        """ Close the LMDB environment. """
+        self.env.close()
+
+    @staticmethod
+    def default_path():
+        """ Return the path to Baloo's index for the current user. """
+        filepath = os.environ.get('FILETAGS_BALOO_INDEX', None)
+        if filepath:
+            return filepath
+        return os.path.join(
+            os.environ.get('XDG_DATA_HOME', None) or
+            os.path.expanduser('~/.local/share'),
+            'baloo',
+            'index')
+
+    def get_path(self, txn, docid):
+        """ Return the path for a document id, or None if it is missing.
+        """
+        names = []
+        ids = []
+        path = None
+        while docid:
+            path = self.paths.get(docid, None)
+            if path is not None:
+                break
+            value = txn.get(self.id_struct.pack(docid), db=self.idfilename)
+            if value is None:
+                return None
+            ids.append(docid)
+            names.append(value[self.id_struct.size:])
+            docid = self.id_struct.unpack_from(value)[0]
+        path = os.fsencode(path or '').rstrip(b'/')
+        for docid, name in zip(reversed(ids), reversed(names)):
+            name = name.strip(b'/')
+            if name:
+                path = b'/'.join((path, name))
+            self.paths[docid] = os.fsdecode(path or b'/')
+        return os.fsdecode(path or b'/')
+
+    def iter_tags(self, txn):
+        """ Yield (tag, posting list bytes) for all indexed tags. """
+        prefixlen = len(self.tag_prefix)
+        with txn.cursor(db=self.postingdb) as cursor:
+            if not cursor.set_range(self.tag_prefix):
+                return None
+            for key, value in cursor:
+                if not key.startswith(self.tag_prefix):
+                    break
+                yield key[prefixlen:].decode('utf-8', 'replace'), value
+
+    def search_tags(self, repat):
+        """ Return a set of paths with tags matching `repat`, a compiled
+            regex or PatternSet.
+        """
+        ids = set()
+        paths = set()
+        with self.env.begin() as txn:
+            for tag, value in self.iter_tags(txn):
+                if repat.search(Editor.fold_key(tag)) is None:
+                    continue
+                cnt = len(value) // self.id_struct.size
+                ids.update(struct.unpack('={}Q'.format(cnt), value))
+            debug('Baloo documents found: {}'.format(len(ids)))
+            for docid in ids:
+                path = self.get_path(txn, docid)
+                if path is None:
+                    debug('Missing Baloo document: {}'.format(docid))
+                    continue
+                paths.add(path)
+        return paths
+
+
+class ChangedSince(object):
+    """ Skips walked paths that haven't changed since a timestamp, by
+        comparing the ctime from the directory scan. Setting or removing
+        an extended attribute updates the ctime, so no attributes are read
+        for unchanged files.
+        With a state file, the timestamp is read from it, and save() writes
+        the time this instance was created (so changes made during the run
+        are seen by the next one), unless the run had errors.
+    """
+    # Formats for dates and times, besides Unix timestamps.
+    time_formats = (
+        '%Y-%m-%d',
+        '%Y-%m-%dT%H:%M',
+        '%Y-%m-%dT%H:%M:%S',
+        '%Y-%m-%d %H:%M',
+        '%Y-%m-%d %H:%M:%S',
+    )
+
+    def __init__(self, timestamp, statefile=None):
+        self.start = time.time()
+        self.timestamp = timestamp
+        self.statefile = statefile
+        # Compare nanoseconds, like st_ctime_ns.
+        self.mark = None if timestamp is None else int(timestamp * 1e9)
+        self.skipped = 0
+
+    @classmethod
+    def from_arg(cls, arg):
+        """ Return a ChangedSince for a --changed-since argument, or None
+            if `arg` is falsey.
+            Possibly raises ValueError for invalid timestamps, or
+            EnvironmentError when reading a state file.
+        """
+        if not arg:
+            return None
+        if not arg.startswith('@'):
+            return cls(cls.parse_time(arg))
+        statefile = arg[1:]
+        try:
+            with open(statefile, 'r') as f:
+                text = f.read().strip()
+        except FileNotFoundError:
+            debug('No state file, using all paths: {}'.format(statefile))
+            return cls(None, statefile=statefile)
+        try:
+            timestamp = cls.parse_time(text)
+        except ValueError as ex:
+            raise ValueError('Invalid state file: {}\n{}'.format(
+                statefile,
+                ex)) from ex
+        return cls(timestamp, statefile=statefile)
+
+    def is_unchanged(self, entry):
+        """ Return True if an os.DirEntry hasn't changed since the
+            timestamp. Symlinks are always used, because their tags are
+            read from the target.
+        """
+        if self.mark is None or entry.is_symlink():
+            return False
+        try:
+            ctime = entry.stat(follow_symlinks=False).st_ctime_ns
+        except EnvironmentError:
+            return False
+        if ctime < self.mark:
+            self.skipped += 1
+            return True
+        return False
+
+    @classmethod
+    def parse_time(cls, s):
+        """ Return a Unix timestamp from a timestamp or date/time string.
+            Raises ValueError for invalid strings.
+        """
+        try:
+            return float(s)
+        except ValueError:
+            pass
+        for fmt in cls.time_formats:
+            try:
+                return datetime.strptime(s, fmt).timestamp()
+            except ValueError:
+                continue
+        raise ValueError(
+            'Invalid time, expecting a Unix timestamp or date: {}'.format(s))
+
+    def save(self, complete=True):
+        """ Write the start time to the state file, if there is one.
+            If `complete` is False (the run had errors), the state file is
+            left alone, so the same paths are used again next time.
+        """
+        debug('Unchanged paths skipped: {}'.format(self.skipped))
+        if not self.statefile:
+            return None
+        if not complete:
+            print_err(
+                'Not updating state file after errors: {}'.format(
+                    self.statefile),
+                count=False)
+            return None
+        tmppath = '{}.tmp'.format(self.statefile)
+        try:
+            with open(tmppath, 'w') as f:
+                f.write('{:.9f}\n'.format(self.start))
+            os.replace(tmppath, self.statefile)
+        except EnvironmentError as ex:
+            print_err(
+                'Unable to save state file: {}'.format(self.statefile),
+                ex)
+        return None
+
+
+class EmptyCache(object):
+    """ A persistent cache of files that have no tags and no comment,
+        keyed by (st_dev, st_ino), and only valid while st_ctime_ns is the
+        same. Setting or removing an extended attribute updates the ctime,
+        so a file is read again after it changes.
+        Symlinks are never cached, because tags are read from the target.
+    """
+    # Binary format for each entry: st_dev, st_ino, st_ctime_ns.
+    entry_struct = struct.Struct('<QQq')
+
+    def __init__(self, root):
+        self.filepath = cache_path('empty.bin', root=root)
+        self.entries = {}
+        self.changed = False
+        self.load()
+
+    def add(self, path):
+        """ Add an empty file to the cache. Symlinks are ignored. """
+        try:
+            st = os.lstat(path)
+        except EnvironmentError:
+            return None
+        if not stat.S_ISLNK(st.st_mode):
+            self.entries[(st.st_dev, st.st_ino)] = st.st_ctime_ns
+            self.changed = True
+        return None
+
+    def is_empty(self, entry):
+        """ Return True if an os.DirEntry is known to have no tags and no
+            comment. Out of date entries are removed.
+        """
+        if entry.is_symlink():
+            return False
+        try:
+            st = entry.stat(follow_symlinks=False)
+        except EnvironmentError:
+            return False
+        key = (st.st_dev, st.st_ino)
+        ctime = self.entries.get(key, None)
+        if ctime is None:
+            return False
+        if ctime == st.st_ctime_ns:
+            return True
+        del self.entries[key]
+        self.changed = True
+        return False
+
+    def load(self):
+        """ Load cache entries from disk, if the cache file exists. """
+        try:
+            with open(self.filepath, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        except EnvironmentError as ex:
+            debug('Unable to read cache: {}'.format(self.filepath), ex=ex)
+            return None
+        # Ignore any partial entry at the end.
+        data = data[:len(data) - (len(data) % self.entry_struct.size)]
+        self.entries = {
+            (dev, ino): ctime
+            for dev, ino, ctime in self.entry_struct.iter_unpack(data)
+        }
+        debug('Loaded {} empty file entries.'.format(len(self.entries)))
+        return None
+
+    def save(self):
+        """ Save cache entries to disk, if anything changed. """
+        if not self.changed:
+            return None
+        tmppath = '{}.tmp'.format(self.filepath)
+        try:
+            with open(tmppath, 'wb') as f:
+                for (dev, ino), ctime in self.entries.items():
+                    f.write(self.entry_struct.pack(dev, ino, ctime))
+            os.replace(tmppath, self.filepath)
+        except EnvironmentError as ex:
+            print_err('Unable to save cache: {}'.format(self.filepath), ex)
+            return None
+        self.changed = False
+        debug('Saved {} empty file entries.'.format(len(self.entries)))
+        return None
+
+
+class SearchCache(object):
+    """ A persistent cache of search results, stored in a sqlite database
+        for each directory and search (the pattern, tags or comments,
+        reverse, folding, and symlink settings).
+        A directory's results are dropped when its mtime changes (entries
+        were added, removed, or renamed), and each file's result is only
+        used while its ctime is the same. Setting or removing an extended
+        attribute updates the ctime.
+        Symlinks are never cached, because tags are read from the target.
+        Only the `max_dirs` most recently used directories are kept.
+    """
+    filename = 'search.db'
+    max_dirs = 10000
+
+    def __init__(self, repat, comments=False, reverse=False):
+        self.filepath = cache_path(self.filename)
+        self.query = self.query_key(repat, comments=comments, reverse=reverse)
+        # Current directory, with its mtime and results, as:
+        #   {name: [ctime_ns, resolved path, matched value or None]}
+        self.dirpath = None
+        self.mtime = None
+        self.entries = {}
+        self.changed = False
+        # Last file checked with get(), as (path, ctime_ns).
+        self.last = (None, None)
+        self.hits = 0
+        self.misses = 0
+        # Recency for the `used` column, increased for each directory so
+        # rows from one run can still be ranked.
+        self.used = time.time_ns()
+        try:
+            self.db = sqlite3.connect(self.filepath)
+            self.db.execute(
+                '''CREATE TABLE IF NOT EXISTS results (
+                    query TEXT NOT NULL,
+                    dirpath TEXT NOT NULL,
+                    mtime INTEGER NOT NULL,
+                    used INTEGER NOT NULL,
+                    entries TEXT NOT NULL,
+                    PRIMARY KEY (query, dirpath)
+                ) WITHOUT ROWID'''
+            )
+            self.db.execute(
+                'CREATE INDEX IF NOT EXISTS results_used ON results (used)')
+        except sqlite3.Error as ex:
+            raise OSError(
+                errno.EIO,
+                'Unable to open search cache: {}\n{}'.format(
+                    self.filepath,
+                    ex))
+        debug('Using search cache: {}'.format(self.filepath))
+
+    def _execute(self, sql, params=()):
+        """ Run a sql statement, returning all rows. Database errors are
+            only printed with --debug, and return no rows.
+        """
+        try:
+            return self.db.execute(sql, params).fetchall()
+        except sqlite3.Error as ex:
+            debug('Search cache error: {}'.format(self.filepath), ex=ex)
+        return []
+
+    def close(self):
+        """ Save results, remove old directories, and close the database. """
+        self.flush()
+        self.prune()
+        with suppress(sqlite3.Error):
+            self.db.commit()
+        self.db.close()
+        debug('Search cache hits: {}, misses: {}'.format(
+            self.hits,
+            self.misses))
+
+    def flush(self):
+        """ Save results for the current directory, if they changed. """
+        if not self.changed:
+            return None
+        self._execute(
+            '''INSERT OR REPLACE INTO results
+                (query, dirpath, mtime, used, entries)
+                VALUES (?, ?, ?, ?, ?)''',
+            (
+                self.query,
+                self.dirpath,
+                self.mtime,
+                self.next_used(),
+                json.dumps(self.entries, separators=(',', ':')),
+            ))
+        self.changed = False
+        return None
+
+    def get(self, filename):
+        """ Return (resolved path, matched value or None) for a cached file,
+            or None if the file must be read.
+        """
+        filename = os.path.abspath(filename)
+        dirpath, name = os.path.split(filename)
+        if dirpath != self.dirpath:
+            self.load(dirpath)
+        self.last = (None, None)
+        try:
+            st = os.lstat(filename)
+        except EnvironmentError:
+            return None
+        if (self.mtime is None) or stat.S_ISLNK(st.st_mode):
+            return None
+        self.last = (filename, st.st_ctime_ns)
+        entry = self.entries.get(name, None)
+        if (entry is None) or (entry[0] != st.st_ctime_ns):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry[1], entry[2]
+
+    def load(self, dirpath):
+        """ Save the current directory, and load results for `dirpath`.
+            Results are dropped if the directory's mtime changed.
+        """
+        self.flush()
+        self.dirpath = dirpath
+        self.entries = {}
+        try:
+            self.mtime = os.stat(dirpath).st_mtime_ns
+        except EnvironmentError:
+            # Not cached.
+            self.mtime = None
+            return None
+        rows = self._execute(
+            '''SELECT mtime, entries FROM results
+                WHERE query = ? AND dirpath = ?''',
+            (self.query, dirpath))
+        if not rows:
+            return None
+        mtime, entries = rows[0]
+        if mtime != self.mtime:
+            debug('Search cache is outdated for: {}'.format(dirpath))
+            self.changed = True
+            return None
+        self.entries = json.loads(entries)
+        self._execute(
+            'UPDATE results SET used = ? WHERE query = ? AND dirpath = ?',
+            (self.next_used(), self.query, dirpath))
+        return None
+
+    def next_used(self):
+        """ Return a recency value for a directory that was just used,
+            larger than any returned before.
+        """
+        self.used += 1
+        return self.used
+
+    def prune(self):
+        """ Remove the least recently used directories, keeping at most
+            `max_dirs`.
+        """
+        self._execute(
+            '''DELETE FROM results WHERE (query, dirpath) NOT IN (
+                SELECT query, dirpath FROM results
+                ORDER BY used DESC, query, dirpath
+                LIMIT ?
+            )''',
+            (self.max_dirs, ))
+        return None
+
+    @staticmethod
+    def query_key(repat, comments=False, reverse=False):
+        """ Return a key for the search, including settings that change the
+            results.
+        """
+        return json.dumps([
+            'comments' if comments else 'tags',
+            bool(reverse),
+            getattr(repat, 'patterns', None) or repat.pattern,
+            getattr(repat, 'flags', 0),
+            Editor.fold_case,
+            Editor.fold_form,
+            Editor.follow_symlinks,
+            Editor.resolver.mode,
+        ])
+
+    def set(self, filename, filepath, value):
+        """ Cache the result for a file that was just checked with get(). """
+        filename = os.path.abspath(filename)
+        lastpath, ctime = self.last
+        if lastpath != filename:
+            # Not cachable.
+            return None
+        self.entries[os.path.basename(filename)] = [ctime, filepath, value]
+        self.changed = True
+        return None
+
+
+class PathResolver(object):
+    """ Makes file paths absolute, resolving symlinks depending on the mode.
+        Resolved directories are cached, so each parent directory is only
+        resolved once.
+        Modes:
+            always        : Resolve all symlinks, like Path.resolve().
+            never         : Only make paths absolute.
+            symlinks-only : Resolve paths that are symlinks themselves.
+    """
+    modes = ('always', 'never', 'symlinks-only')
+
+    def __init__(self, mode='always'):
+        if mode not in self.modes:
+            raise ValueError(
+                'Invalid resolve mode, expecting one of: {}'.format(
+                    ', '.join(self.modes)))
+        self.mode = mode
+        # Directory path -> Resolved directory path.
+        self.dirs = {}
+
+    def add_dir(self, dirpath):
+        """ Mark a directory path as already resolved. """
+        self.dirs[dirpath] = dirpath
+
+    def resolve(self, path):
+        """ Return an absolute, possibly resolved, path str for `path`. """
+        path = os.path.abspath(path)
+        if self.mode == 'never':
+            return path
+        if os.path.islink(path):
+            return os.path.realpath(path)
+        if self.mode == 'symlinks-only':
+            return path
+        parent, name = os.path.split(path)
+        if not name:
+            # Root directory.
+            return path
+        return os.path.join(self.resolve_dir(parent), name)
+
+    def resolve_dir(self, dirpath):
+        """ Return the resolved path for an absolute directory path,
+            using the cache when possible.
+        """
+        resolved = self.dirs.get(dirpath, None)
+        if resolved is None:
+            resolved = self.dirs[dirpath] = os.path.realpath(dirpath)
+        return resolved
+
+
+class PatternSet(object):
+    """ A set of search patterns, matched in a single pass over each string.
+        Patterns follow `re` rules, but literal patterns are matched without
+        `re`:
+            ^text$ : Exact matches, with a dict lookup.
+            ^text  : Prefixes, \
+            text$  : Suffixes,  > with one Aho-Corasick automaton.
+            text   : Substrings /
+        Anything else is compiled and tried with `re`.
+    """
+    # Characters that make a pattern more than a literal, unless escaped.
+    special_chars = set('.^$*+?{}[]|()')
+
+    def __init__(self, patterns, name=None, fold=None):
+        self.patterns = []
+        # Pattern order, for reporting matches in file order.
+        self.order = {}
+        # Literal string -> pattern, for exact matches.
+        self.exact = {}
+        # (pattern, compiled regex) for patterns that aren't literals.
+        self.regexes = []
+        # Automaton for prefixes, suffixes, and substrings.
+        self.goto = [{}]
+        self.fail = [0]
+        # Node index -> [(literal length, kind, pattern), ...]
+        self.out = [[]]
+        for pattern in patterns:
+            if fold is None:
+                self.add(pattern)
+            else:
+                self.add(fold(pattern), label=pattern)
+        self._build()
+        # For debug messages, like a compiled regex's `pattern`.
+        self.pattern = name or '|'.join(self.patterns)
+
+    def __len__(self):
+        return len(self.patterns)
+
+    def _build(self):
+        """ Build failure links for the automaton (breadth first), merging
+            the output of each node's failure node into it's own.
+        """
+        self.fail = [0] * len(self.goto)
+        queue = deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for c, child in self.goto[node].items():
+                queue.append(child)
+                f = self.fail[node]
+                while f and (c not in self.goto[f]):
+                    f = self.fail[f]
+                self.fail[child] = self.goto[f].get(c, 0)
+                self.out[child] = self.out[child] + self.out[self.fail[child]]
+
+    def _iter_literals(self, s):
+        """ Yield patterns from the automaton that match `s`. """
+        goto, fail, out = self.goto, self.fail, self.out
+        # Like `re`, $ also matches before a trailing newline.
+        last = len(s) - 1
+        lastlines = {last, last - 1} if s.endswith('\n') else {last}
+        node = 0
+        for i, c in enumerate(s):
+            while node and (c not in goto[node]):
+                node = fail[node]
+            node = goto[node].get(c, 0)
+            for length, kind, pattern in out[node]:
+                if kind == 'prefix':
+                    if i + 1 == length:
+                        yield pattern
+                elif kind == 'suffix':
+                    if i in lastlines:
+                        yield pattern
+                else:
+                    yield pattern
+
+    def _iter_matches(self, s):
+        """ Yield all patterns that match `s`, exact matches first. """
+        pattern = self.exact.get(s, None)
+        if (pattern is None) and s.endswith('\n'):
+            pattern = self.exact.get(s[:-1], None)
+        if pattern is not None:
+            yield pattern
+        yield from self._iter_literals(s)
+        for pattern, repat in self.regexes:
+            if repat.search(s) is not None:
+                yield pattern
+
+    def add(self, pattern, label=None):
+        """ Add a pattern, classifying it as an exact match, prefix, suffix,
+            substring, or regex.
+            Matches are reported as `label`, or the pattern itself.
+            Possibly raises re.error for invalid regex patterns.
+            Call _build() after adding patterns.
+        """
+        label = pattern if label is None else label
+        if label in self.order:
+            return None
+        start = pattern.startswith('^')
+        body = pattern[1:] if start else pattern
+        end = body.endswith('$')
+        literal = self.parse_literal(body[:-1] if end else body)
+        if literal is None or not (literal or (start and end)):
+            # Empty prefixes/suffixes/substrings match everything, leave
+            # them to `re`.
+            self.regexes.append((label, re.compile(pattern)))
+        elif start and end:
+            self.exact.setdefault(literal, label)
+        else:
+            if start:
+                kind = 'prefix'
+            elif end:
+                kind = 'suffix'
+            else:
+                kind = 'substring'
+            node = 0
+            for c in literal:
+                nextnode = self.goto[node].get(c, None)
+                if nextnode is None:
+                    nextnode = len(self.goto)
+                    self.goto.append({})
+                    self.out.append([])
+                    self.goto[node][c] = nextnode
+                node = nextnode
+            self.out[node].append((len(literal), kind, label))
+        self.order[label] = len(self.patterns)
+        self.patterns.append(label)
+
+    @classmethod
+    def from_file(cls, filepath, fold=None):
+        """ Load patterns from a file, one per line, skipping blank lines
+            and lines starting with #.
+            If `fold` is given, it is called to transform each pattern
+            before it is used, but the original is reported in matches.
+            Possibly raises EnvironmentError, or ValueError for invalid
+            regex patterns and files without any patterns.
+        """
+        patterns = []
+        with open(filepath, 'r') as f:
+            for lineno, line in enumerate(f, start=1):
+                line = line.rstrip('\r\n')
+                if (not line.strip()) or line.startswith('#'):
+                    continue
+                try:
+                    re.compile(line if fold is None else fold(line))
+                except re.error as ex:
+                    raise ValueError(
+                        'Invalid pattern in {}, line {}: {} ({})'.format(
+                            filepath,
+                            lineno,
+                            line,
+                            ex)) from ex
+                patterns.append(line)
+        if not patterns:
+            raise ValueError('No patterns in file: {}'.format(filepath))
+        pset = cls(patterns, name='@{}'.format(filepath), fold=fold)
+        debug('Loaded {} patterns ({} exact, {} regex) from: {}'.format(
+            len(pset),
+            len(pset.exact),
+            len(pset.regexes),
+            filepath))
+        return pset
+
+    @classmethod
+    def parse_literal(cls, s):
+        """ Return the literal text for a pattern with no special
+            characters, unescaping escaped punctuation.
+            Returns None if the pattern needs `re`.
+        """
+        chars = []
+        escaped = False
+        for c in s:
+            if escaped:
+                if c.isalnum():
+                    # \d, \b, \1, etc.
+                    return None
+                chars.append(c)
+                escaped = False
+            elif c == '\\':
+                escaped = True
+            elif c in cls.special_chars:
+                return None
+            else:
+                chars.append(c)
+        if escaped:
+            return None
+        return ''.join(chars)
+
+    def search(self, s):
+        """ Return the first pattern matching `s`, or None.
+            This is the only part of the compiled regex API used by
+            searches.
+        """
+        for pattern in self._iter_matches(s):
+            return pattern
+        return None
+
+    def which(self, strings):
+        """ Return all patterns matching any of `strings`, in the order
+            they were added.
+        """
+        matched = set()
+        for s in strings:
+            matched.update(self._iter_matches(s))
+        return sorted(matched, key=self.order.__getitem__)
+
+
+class TimedStore(object):
+    """ Wraps an attribute store, recording the latency of each call in a
+        Metrics instance.
+    """
+    def __init__(self, store, metrics):
+        self.store = store
+        self.metrics = metrics
+
+    def __getattr__(self, name):
+        return getattr(self.store, name)
+
+    def _timed(self, op, func, *args, **kwargs):
+        """ Call func(*args, **kwargs), recording how long it took. """
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.metrics.observe(op, time.perf_counter() - start)
+
+    def getxattr(self, path, attrname, symlink=False):
+        """ Return the raw bytes value for an attribute. """
+        return self._timed(
+            'get',
+            self.store.getxattr,
+            path,
+            attrname,
+            symlink=symlink)
+
+    def listxattr(self, path, symlink=False):
+        """ Return a list of attribute names for a file. """
+        return self._timed(
+            'list',
+            self.store.listxattr,
+            path,
+            symlink=symlink)
+
+    def removexattr(self, path, attrname, symlink=False):
+        """ Remove an attribute from a file. """
+        return self._timed(
+            'remove',
+            self.store.removexattr,
+            path,
+            attrname,
+            symlink=symlink)
+
+    def setxattr(self, path, attrname, value, symlink=False):
+        """ Set the raw bytes value for an attribute. """
+        return self._timed(
+            'set',
+            self.store.setxattr,
+            path,
+            attrname,
+            value,
+            symlink=symlink)
+
+
+class Snapshot(object):
+    """ A read-only, memory-mapped snapshot of tags and comments for many
+        files, made with Snapshot.write(). Searching a snapshot does not
+        touch the file system, and processes can share the page-cached file
+        without loading it.
+
+        Format (little-endian):
+            header   : magic, file count, tag count, and section offsets.
+            files    : A record for each file, sorted by path, with the
+                       path, comment, and tag ids (offsets into the blob
+                       and filetags sections), and flags.
+            tags     : A record for each tag, sorted by name, with the
+                       name, and file ids (offsets into blob and postings).
+            postings : Sorted file ids (uint32) for each tag.
+            filetags : Sorted tag ids (uint32) for each file.
+            blob     : UTF-8 encoded strings.
+    """
+    magic = b'FTSNAP\x00\x01'
+    header_struct = struct.Struct('<8sIIQQQQQ')
+    # path offset/length, comment offset/length, tag id start/count, flags.
+    file_struct = struct.Struct('<QIQIIII')
+    # name offset/length, file id start/count.
+    tag_struct = struct.Struct('<QIII')
+    id_struct = struct.Struct('<I')
+    # File record flags.
+    flag_dir = 1
+
+    def __init__(self, filepath):
+        """ Open and memory-map a snapshot file.
+            Possibly raises EnvironmentError, or ValueError for invalid files.
+        """
+        self.filepath = filepath
+        with open(filepath, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.map.size() < self.header_struct.size:
+            self.close()
+            raise ValueError('Not a snapshot file: {}'.format(filepath))
+        (
+            magic,
+            self.file_cnt,
+            self.tag_cnt,
+            self.off_files,
+            self.off_tags,
+            self.off_postings,
+            self.off_filetags,
+            self.off_blob,
+        ) = self.header_struct.unpack_from(self.map, 0)
+        sections = (
+            self.header_struct.size,
+            self.off_files,
+            self.off_files + (self.file_cnt * self.file_struct.size),
+            self.off_tags,
+            self.off_tags + (self.tag_cnt * self.tag_struct.size),
+            self.off_postings,
+            self.off_filetags,
+            self.off_blob,
+            self.map.size(),
+        )
+        valid = (magic == self.magic) and (
+            list(sections) == sorted(sections)
+        )
+        if not valid:
+            self.close()
+            raise ValueError('Not a snapshot file: {}'.format(filepath))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exctype, excvalue, tb):
+        self.close()
+        return False
+
+    def _check(self, end, sectionend):
+        """ Raise ValueError if data ending at `end` runs past a section
+            ending at `sectionend`, for truncated or damaged files.
+        """
+        if end > sectionend:
+            raise ValueError('Not a snapshot file: {}'.format(self.filepath))
+
+    def _ids(self, offset, start, cnt):
+        """ Return a list of uint32 ids from a section. """
+        begin = offset + (start * self.id_struct.size)
+        end = begin + (cnt * self.id_struct.size)
+        if offset == self.off_postings:
+            self._check(end, self.off_filetags)
+        else:
+            self._check(end, self.off_blob)
+        return list(struct.unpack_from('<{}I'.format(cnt), self.map, begin))
+
+    def _str(self, offset, length):
+        """ Return a decoded str from the blob section. """
+        start = self.off_blob + offset
+        self._check(start + length, self.map.size())
+        return self.map[start:start + length].decode(errors='surrogateescape')
+
+    def close(self):
+        """ Close the memory map. """
+        self.map.close()
+
+    def file(self, fileid):
+        """ Return a tuple of (path, isdir, tag ids, comment) for a file id.
+        """
+        (
+            pathoff, pathlen,
+            commentoff, commentlen,
+            tagstart, tagcnt,
+            flags
+        ) = self.file_struct.unpack_from(
+            self.map,
+            self.off_files + (fileid * self.file_struct.size))
+        return (
+            self._str(pathoff, pathlen),
+            bool(flags & self.flag_dir),
+            self._ids(self.off_filetags, tagstart, tagcnt),
+            self._str(commentoff, commentlen),
+        )
+
+    def search_comments(self, repat, reverse=False):
+        """ Yield (path, isdir, comment) for files with comments that match
+            `repat` (or don't match, when `reverse` is used).
+        """
+        for fileid in range(self.file_cnt):
+            path, isdir, _, comment = self.file(fileid)
+            folded = Editor.fold_key(comment, cache=False)
+            if (repat.search(folded) is None) == reverse:
+                yield path, isdir, comment
+
+    def search_tags(self, repat, reverse=False):
+        """ Yield (path, isdir, tags) for files with any tags that match
+            `repat`, or no tags matching when `reverse` is used.
+            Files with no tags are tested against '', like
+            Editor.match_tags().
+        """
+        tagnames = [self.tag(tagid)[0] for tagid in range(self.tag_cnt)]
+        matchids = set()
+        for tagid, tagname in enumerate(tagnames):
+            if repat.search(Editor.fold_key(tagname)) is not None:
+                _, start, cnt = self.tag(tagid)
+                matchids.update(self._ids(self.off_postings, start, cnt))
+        emptymatch = (repat.search('') is not None) != reverse
+        if reverse or emptymatch:
+            fileids = range(self.file_cnt)
+        else:
+            fileids = sorted(matchids)
+        for fileid in fileids:
+            path, isdir, tagids, _ = self.file(fileid)
+            if tagids:
+                if (fileid in matchids) == reverse:
+                    continue
+            elif not emptymatch:
+                continue
+            yield path, isdir, [tagnames[tagid] for tagid in tagids]
+
+    def tag(self, tagid):
+        """ Return a tuple of (name, file id start, file id count) for a tag
+            id.
+        """
+        nameoff, namelen, start, cnt = self.tag_struct.unpack_from(
+            self.map,
+            self.off_tags + (tagid * self.tag_struct.size))
+        return self._str(nameoff, namelen), start, cnt
+
+    @classmethod
+    def write(cls, filepath, records):
+        """ Write a snapshot file from an iterable of
+            (path, isdir, tags, comment) tuples.
+            The file is replaced atomically, so open snapshots are not
+            affected.
+            Possibly raises EnvironmentError.
+        """
+        records = sorted(records)
+        tagnames = sorted({tag for _, _, tags, _ in records for tag in tags})
+        tagids = {tag: i for i, tag in enumerate(tagnames)}
+        blob = bytearray()
+
+        def add_str(s):
+            offset = len(blob)
+            blob.extend(s.encode(errors='surrogateescape'))
+            return offset, len(blob) - offset
+
+        postings = [[] for _ in tagnames]
+        filetags = []
+        filerecs = []
+        for fileid, (path, isdir, tags, comment) in enumerate(records):
+            ids = sorted(tagids[tag] for tag in set(tags))
+            for tagid in ids:
+                postings[tagid].append(fileid)
+            filerecs.append(cls.file_struct.pack(
+                *add_str(path),
+                *add_str(comment or ''),
+                len(filetags),
+                len(ids),
+                cls.flag_dir if isdir else 0))
+            filetags.extend(ids)
+        tagrecs = []
+        postingids = []
+        for tagname, fileids in zip(tagnames, postings):
+            tagrecs.append(cls.tag_struct.pack(
+                *add_str(tagname),
+                len(postingids),
+                len(fileids)))
+            postingids.extend(fileids)
+
+        off_files = cls.header_struct.size
+        off_tags = off_files + (len(filerecs) * cls.file_struct.size)
+        off_postings = off_tags + (len(tagrecs) * cls.tag_struct.size)
+        off_filetags = off_postings + (len(postingids) * cls.id_struct.size)
+        off_blob = off_filetags + (len(filetags) * cls.id_struct.size)
+        tmppath = '{}.tmp'.format(filepath)
+        with open(tmppath, 'wb') as f:
+            f.write(cls.header_struct.pack(
+                cls.magic,
+                len(filerecs),
+                len(tagrecs),
+                off_files,
+                off_tags,
+                off_postings,
+                off_filetags,
+                off_blob))
+            f.write(b''.join(filerecs))
+            f.write(b''.join(tagrecs))
+            f.write(struct.pack('<{}I'.format(len(postingids)), *postingids))
+            f.write(struct.pack('<{}I'.format(len(filetags)), *filetags))
+            f.write(blob)
+        os.replace(tmppath, filepath)
+
+
+class AttrStore(object):
+    """ Base class for attribute stores (Editor.store).
+        All attribute stores have the same methods as the xattr module,
+        raising EnvironmentError with errno set to ENODATA for missing
+        attributes.
+    """
+
+    def close(self):
+        """ Save any changes and release resources. """
+        return None
+
+    def getxattr(self, path, attrname, symlink=False):
+        """ Return the raw bytes value for an attribute. """
+        raise NotImplementedError('getxattr() must be overridden.')
+
+    def listxattr(self, path, symlink=False):
+        """ Return a list of attribute names for a file. """
+        raise NotImplementedError('listxattr() must be overridden.')
+
+    def removexattr(self, path, attrname, symlink=False):
+        """ Remove an attribute from a file. """
+        raise NotImplementedError('removexattr() must be overridden.')
+
+    def setxattr(self, path, attrname, value, symlink=False):
+        """ Set the raw bytes value for an attribute. """
+        raise NotImplementedError('setxattr() must be overridden.')
+
+
+class XattrStore(AttrStore):
+    """ Stores attributes as extended attributes, using the xattr module.
+    """
+
+    def getxattr(self, path, attrname, symlink=False):
+        """ Return the raw bytes value for an attribute. """
+        return xattr.getxattr(path, attrname, symlink=symlink)
+
+    def listxattr(self, path, symlink=False):
+        """ Return a list of attribute names for a file. """
+        return xattr.listxattr(path, symlink=symlink)
+
+    def removexattr(self, path, attrname, symlink=False):
+        """ Remove an attribute from a file. """
+        return xattr.removexattr(path, attrname, symlink=symlink)
+
+    def setxattr(self, path, attrname, value, symlink=False):
+        """ Set the raw bytes value for an attribute. """
+        return xattr.setxattr(path, attrname, value, symlink=symlink)
+
+
+class SidecarStore(AttrStore):
+    """ Stores attributes in a sqlite database at the root of a tree,
+        for file systems that don't support extended attributes.
+        Paths below the root are stored relative to it, so the tree can be
+        moved or copied with the database.
+        Changes are committed in batches, and when the store is closed.
+    """
+    filename = '.filetags.db'
+    # Number of writes between commits.
+    commit_interval = 1000
+
+    def __init__(self, root):
+        self.root = root
+        self.filepath = os.path.join(root, self.filename)
+        self.writes = 0
+        # The store may be shared between threads.
+        self.lock = threading.Lock()
+        try:
+            self.db = sqlite3.connect(self.filepath, check_same_thread=False)
+            self.db.execute(
+                '''CREATE TABLE IF NOT EXISTS attrs (
+                    path TEXT NOT NULL,
+                    name TEXT NOT NULL,
+                    value BLOB,
+                    PRIMARY KEY (path, name)
+                ) WITHOUT ROWID'''
+            )
+        except sqlite3.Error as ex:
+            raise OSError(
+                errno.EIO,
+                'Unable to open sidecar file: {}\n{}'.format(
+                    self.filepath,
+                    ex))
+        debug('Using sidecar file: {}'.format(self.filepath))
+
+    def _execute(self, sql, params=()):
+        """ Run a sql statement, returning all rows.
+            Raises OSError on database errors, so they are handled like
+            other attribute errors.
+        """
+        with self.lock:
+            try:
+                return self.db.execute(sql, params).fetchall()
+            except sqlite3.Error as ex:
+                raise OSError(errno.EIO, 'Sidecar error: {}'.format(ex))
+
+    def _key(self, path):
+        """ Return the database key for a file path. """
+        relpath = os.path.relpath(path, self.root)
+        if (relpath == os.pardir) or relpath.startswith(os.pardir + os.sep):
+            return path
+        return relpath
+
+    def _row(self, path, attrname):
+        """ Return the database row for an attribute as a tuple of (value,),
+            or None if there is no row.
+            Rows with a value of None are known to be missing.
+        """
+        rows = self._execute(
+            'SELECT value FROM attrs WHERE path = ? AND name = ?',
+            (self._key(path), attrname))
+        return rows[0] if rows else None
+
+    def _write(self, path, attrname, value):
+        """ Set the value for an attribute, where None means missing. """
+        self._execute(
+            '''INSERT OR REPLACE INTO attrs (path, name, value)
+                VALUES (?, ?, ?)''',
+            (self._key(path), attrname, value))
+        self.writes += 1
+        if self.writes % self.commit_interval == 0:
+            self.commit()
+
+    def close(self):
+        """ Commit any changes and close the database. """
+        self.commit()
+        with self.lock:
+            self.db.close()
+
+    def commit(self):
+        """ Commit any changes to the database. """
+        with self.lock:
+            try:
+                self.db.commit()
+            except sqlite3.Error as ex:
+                raise OSError(errno.EIO, 'Sidecar error: {}'.format(ex))
+
+    @classmethod
+    def find_root(cls, path):
+        """ Return the closest directory to `path` (including `path`) with a
+            sidecar file, or `path` if there are none.
+        """
+        for parent in [Path(path)] + list(Path(path).parents):
+            if (parent / cls.filename).exists():
+                return str(parent)
+        return path
+
+    def getxattr(self, path, attrname, symlink=False):
+        row = self._row(path, attrname)
+        if (row is None) or (row[0] is None):
+            raise OSError(errno.ENODATA, 'No data available', path)
+        return row[0]
+
+    def listxattr(self, path, symlink=False):
+        rows = self._execute(
+            'SELECT name FROM attrs WHERE path = ? AND value IS NOT NULL',
+            (self._key(path), ))
+        return [name for name, in rows]
+
+    def removexattr(self, path, attrname, symlink=False):
+        # Raises ENODATA for missing attributes, like xattr.
+        self.getxattr(path, attrname)
+        self._execute(
+            'DELETE FROM attrs WHERE path = ? AND name = ?',
+            (self._key(path), attrname))
+        self.writes += 1
+
+    def setxattr(self, path, attrname, value, symlink=False):
+        self._write(path, attrname, value)
+
+
+class MirrorStore(SidecarStore):
+    """ Reads attributes from the sidecar database, falling back to
+        extended attributes and saving what was read (or missing).
+        Saved rows are only used while the file's st_ctime_ns is unchanged,
+        so changes made by other programs are read again.
+        Writes go to extended attributes and the sidecar database. If
+        extended attributes are not supported, only the sidecar is written.
+    """
+    # Errors from xattr that mean the sidecar is the only storage.
+    errnos_unsupported = {errno.ENOTSUP, errno.EOPNOTSUPP, errno.EPERM}
+
+    def __init__(self, root):
+        super().__init__(root)
+        self._execute(
+            '''CREATE TABLE IF NOT EXISTS ctimes (
+                path TEXT NOT NULL PRIMARY KEY,
+                ctime INTEGER NOT NULL
+            ) WITHOUT ROWID'''
+        )
+
+    def _forget(self, path):
+        """ Remove all saved rows for a path. """
+        key = self._key(path)
+        self._execute('DELETE FROM attrs WHERE path = ?', (key, ))
+        self._execute('DELETE FROM ctimes WHERE path = ?', (key, ))
+
+    def _is_current(self, path, symlink=False):
+        """ Return True if the saved rows for a path were read or written
+            since the file last changed.
+        """
+        rows = self._execute(
+            'SELECT ctime FROM ctimes WHERE path = ?',
+            (self._key(path), ))
+        return bool(rows) and (rows[0][0] == self._stat_ctime(path, symlink))
+
+    def _stamp(self, path, symlink=False):
+        """ Mark the saved rows for a path as current. """
+        ctime = self._stat_ctime(path, symlink)
+        if ctime is None:
+            return
+        self._execute(
+            '''INSERT OR REPLACE INTO ctimes (path, ctime)
+                VALUES (?, ?)''',
+            (self._key(path), ctime))
+
+    @staticmethod
+    def _stat_ctime(path, symlink=False):
+        """ Return st_ctime_ns for a path, or None if it can't be stat'd. """
+        try:
+            st = os.lstat(path) if symlink else os.stat(path)
+        except EnvironmentError:
+            return None
+        return st.st_ctime_ns
+
+    def _write_through(self, func, path, attrname, value, symlink=False):
+        """ Write an attribute to extended attributes (if supported) and
+            the sidecar database, where a value of None removes it.
+        """
+        args = (path, attrname) if value is None else (path, attrname, value)
+        current = self._is_current(path, symlink=symlink)
+        if not self._xattr_call(func, *args, symlink=symlink):
+            # The sidecar is the only storage for this file.
+            self._write(path, attrname, value)
+            return
+        if not current:
+            self._forget(path)
+        self._write(path, attrname, value)
+        self._stamp(path, symlink=symlink)
+
+    def _xattr_call(self, func, *args, **kwargs):
+        """ Call an xattr function, ignoring unsupported file systems.
+            Returns True if the call was made.
+        """
+        try:
+            func(*args, **kwargs)
+        except EnvironmentError as ex:
+            if ex.errno in self.errnos_unsupported:
+                return False
+            if ex.errno == errno.ENODATA:
+                return True
+            raise
+        return True
+
+    def getxattr(self, path, attrname, symlink=False):
+        row = self._row(path, attrname)
+        if (row is not None) and self._is_current(path, symlink=symlink):
+            if row[0] is None:
+                raise OSError(errno.ENODATA, 'No data available', path)
+            return row[0]
+        try:
+            value = xattr.getxattr(path, attrname, symlink=symlink)
+        except EnvironmentError as ex:
+            if ex.errno in self.errnos_unsupported:
+                # The sidecar is the only storage for this file.
+                return super().getxattr(path, attrname, symlink=symlink)
+            if ex.errno != errno.ENODATA:
+                raise
+            value = None
+        if not self._is_current(path, symlink=symlink):
+            # Other saved attributes for this file may be out of date.
+            self._forget(path)
+        self._write(path, attrname, value)
+        self._stamp(path, symlink=symlink)
+        if value is None:
+            raise OSError(errno.ENODATA, 'No data available', path)
+        return value
+
+    def listxattr(self, path, symlink=False):
+        names = set(super().listxattr(path, symlink=symlink))
+        with suppress(EnvironmentError):
+            names.update(xattr.listxattr(path, symlink=symlink))
+        return sorted(names)
+
+    def removexattr(self, path, attrname, symlink=False):
+        self._write_through(
+            xattr.removexattr,
+            path,
+            attrname,
+            None,
+            symlink=symlink)
+
+    def setxattr(self, path, attrname, value, symlink=False):
+        self._write_through(
+            xattr.setxattr,
+            path,
+            attrname,
+            value,
+            symlink=symlink)
+
+
+class SupportCache(object):
+    """ Remembers which file systems (by st_dev) support extended
+        attributes, checking each one once with Editor.store.
+        Files are checked by their parent directory, so they don't need to
+        be stat'd. Directories are checked by their own st_dev, so mount
+        points are judged by the file system mounted there, and
+        unsupported directories can be pruned from the walk.
+    """
+    errnos_unsupported = {errno.ENOTSUP, errno.EOPNOTSUPP}
+
+    def __init__(self):
+        # st_dev -> True/False
+        self.devices = {}
+        # Directory path -> st_dev
+        self.dirs = {}
+        # st_dev -> Number of paths skipped.
+        self.skipped = Counter()
+        # st_dev -> First directory found on that file system.
+        self.mounts = {}
+
+    def _probe(self, dirpath):
+        """ Return True if the file system for `dirpath` supports extended
+            attributes.
+        """
+        try:
+            Editor.store.getxattr(dirpath, Editor.attr_tags)
+        except EnvironmentError as ex:
+            if ex.errno in self.errnos_unsupported:
+                debug('No extended attribute support: {}'.format(dirpath))
+                return False
+        return True
+
+    def device(self, dirpath):
+        """ Return st_dev for a directory, probing new file systems.
+            Returns None if the directory can't be stat'd.
+        """
+        dev = self.dirs.get(dirpath, None)
+        if dev is not None:
+            return dev
+        try:
+            dev = os.stat(dirpath).st_dev
+        except EnvironmentError:
+            return None
+        self.dirs[dirpath] = dev
+        if dev not in self.devices:
+            self.devices[dev] = self._probe(dirpath)
+            self.mounts[dev] = dirpath
+        return dev
+
+    def is_unsupported(self, entry):
+        """ Return True if an os.DirEntry is on a file system without
+            extended attribute support, counting the skipped paths.
+        """
+        try:
+            isdir = entry.is_dir() and not entry.is_symlink()
+        except EnvironmentError:
+            isdir = False
+        if isdir:
+            dev = self.device(entry.path)
+        else:
+            dev = self.device(os.path.dirname(entry.path))
+        if (dev is None) or self.devices[dev]:
+            return False
+        self.skipped[dev] += 1
+        return True
+
+    def is_unsupported_dir(self, dirpath):
+        """ Return True if a directory is on a file system without extended
+            attribute support, for get_filenames(prune=...).
+            Its contents are not counted, because they are never listed.
+        """
+        dev = self.device(dirpath)
+        if (dev is None) or self.devices[dev]:
+            return False
+        debug('Pruning unsupported directory: {}'.format(dirpath))
+        return True
+
+    def print_summary(self):
+        """ Print the number of paths skipped for each file system. """
+        for dev, cnt in sorted(self.skipped.items()):
+            print_err(
+                'Skipped {} path{} on a file system without extended '
+                'attribute support:'.format(cnt, '' if cnt == 1 else 's'),
+                self.mounts[dev],
+                count=False)
+
+
+class InodeCache(object):
+    """ Attribute values for files with several names (hard links, or
+        symlinks), keyed by (st_dev, st_ino). Attributes belong to the inode,
+        so each one only needs to be read once, and written once.
+        Values from before the first write are kept, so each name can
+        report the same change.
+        Files with one name are not cached, to save memory.
+    """
+    def __init__(self):
+        # (st_dev, st_ino) -> {attrname: value or None}
+        self.attrs = {}
+        # Set of ((st_dev, st_ino), attrname) that have been written.
+        self.written = set()
+        # ((st_dev, st_ino), attrname) -> value before the first write.
+        self.original = {}
+
+    def get(self, key, attrname, original=False):
+        """ Return a tuple of (found, value) for a cached attribute.
+            If `original` is True, attributes that were written are returned
+            as they were before the first write.
+        """
+        if original and ((key, attrname) in self.original):
+            return True, self.original[(key, attrname)]
+        attrs = self.attrs.get(key, {})
+        if attrname in attrs:
+            return True, attrs[attrname]
+        return False, None
+
+    def key(self, path, filepath):
+        """ Return the cache key for a file, or None if it should not be
+            cached. `path` is the path given to Editor, and `filepath` is
+            the resolved path.
+        """
+        try:
+            st = os.stat(filepath)
+        except EnvironmentError:
+            return None
+        if stat.S_ISDIR(st.st_mode) or (st.st_nlink < 2):
+            if not os.path.islink(str(path)):
+                return None
+        return (st.st_dev, st.st_ino)
+
+    def set(self, key, attrname, value, written=False):
+        """ Cache an attribute value (None for missing attributes). """
+        if written and ((key, attrname) not in self.written):
+            found, oldvalue = self.get(key, attrname)
+            if found:
+                self.original[(key, attrname)] = oldvalue
+            self.written.add((key, attrname))
+        self.attrs.setdefault(key, {})[attrname] = value
+
+    def was_written(self, key, attrname):
+        """ Return True if an attribute was already written for a key. """
+        return (key, attrname) in self.written
+
+
+class Vocabulary(object):
+    """ A persistent count of files for each distinct tag in a directory
+        tree (root), stored in a sqlite database for fast completion.
+        Roots are added with refresh(). Tag changes made with this tool are
+        collected with update(), and applied to every root containing the
+        file by save(). Tags changed by other programs need a refresh().
+        The database is only opened when needed, and never created by
+        reading or saving.
+        All tags are also written to a text file, one per line and most
+        common first, for shell completion scripts that can't wait for
+        python to start.
+    """
+    filename = 'vocabulary.db'
+    textfilename = 'vocabulary.txt'
+    # Seconds to wait for other processes using the database.
+    timeout = 5
+
+    def __init__(self):
+        self.filepath = os.path.join(CACHEDIR, self.filename)
+        # Directory -> Counter of changes to tag counts, until save().
+        self.deltas = {}
+        # Tags may be set from several threads.
+        self.lock = threading.Lock()
+
+    def _connect(self, create=False):
+        """ Return a connection to the database, or None if it doesn't exist
+            and `create` is False.
+            Raises OSError on database errors.
+        """
+        if not (create or os.path.exists(self.filepath)):
+            return None
+        try:
+            db = sqlite3.connect(
+                cache_path(self.filename),
+                timeout=self.timeout)
+            db.execute(
+                '''CREATE TABLE IF NOT EXISTS vocabulary (
+                    root TEXT NOT NULL,
+                    tag TEXT NOT NULL,
+                    count INTEGER NOT NULL,
+                    PRIMARY KEY (root, tag)
+                ) WITHOUT ROWID'''
+            )
+            db.execute(
+                '''CREATE TABLE IF NOT EXISTS roots (
+                    root TEXT PRIMARY KEY,
+                    refreshed REAL NOT NULL
+                )'''
+            )
+        except sqlite3.Error as ex:
+            raise OSError(
+                errno.EIO,
+                'Unable to open vocabulary: {}\n{}'.format(self.filepath, ex))
+        return db
+
+    @staticmethod
+    def _contains(root, path):
+        """ Return True if `path` is `root`, or inside of it. """
+        return path == root or path.startswith(root.rstrip(os.sep) + os.sep)
+
+    def export(self, db):
+        """ Write all tags, for every root, to the text file. """
+        rows = db.execute(
+            '''SELECT tag FROM vocabulary
+                GROUP BY tag ORDER BY SUM(count) DESC, tag''').fetchall()
+        textpath = cache_path(self.textfilename)
+        tmppath = '{}.tmp'.format(textpath)
+        with open(tmppath, 'w') as f:
+            f.writelines('{}\n'.format(tag) for tag, in rows)
+        os.replace(tmppath, textpath)
+
+    def get_counts(self, dirpath):
+        """ Return a list of (tag, count) for the tree at `dirpath`, most
+            common first, or None if there is no vocabulary for it.
+            The closest root at or above `dirpath` is used. Otherwise,
+            the counts for all roots inside of it are added together.
+            Raises OSError on database errors.
+        """
+        db = self._connect()
+        if db is None:
+            return None
+        dirpath = os.path.realpath(dirpath)
+        try:
+            with db:
+                roots = [
+                    root for root, in db.execute('SELECT root FROM roots')
+                ]
+                parents = [r for r in roots if self._contains(r, dirpath)]
+                if parents:
+                    roots = [max(parents, key=len)]
+                else:
+                    roots = [r for r in roots if self._contains(dirpath, r)]
+                if not roots:
+                    return None
+                counts = Counter()
+                for root in roots:
+                    counts.update(dict(db.execute(
+                        'SELECT tag, count FROM vocabulary WHERE root = ?',
+                        (root, ))))
+        except sqlite3.Error as ex:
+            raise OSError(errno.EIO, 'Vocabulary error: {}'.format(ex))
+        finally:
+            db.close()
+        return sorted(counts.items(), key=lambda item: (-item[1], item[0]))
+
+    def refresh(self, root, counts):
+        """ Replace the vocabulary for `root` with a Counter of
+            {tag: file count}.
+            Raises OSError on database errors.
+        """
+        root = os.path.realpath(root)
+        db = self._connect(create=True)
+        try:
+            with db:
+                db.execute('DELETE FROM vocabulary WHERE root = ?', (root, ))
+                db.executemany(
+                    '''INSERT INTO vocabulary (root, tag, count)
+                        VALUES (?, ?, ?)''',
+                    ((root, tag, cnt) for tag, cnt in counts.items() if cnt))
+                db.execute(
+                    '''INSERT OR REPLACE INTO roots (root, refreshed)
+                        VALUES (?, ?)''',
+                    (root, time.time()))
+                self.export(db)
+        except sqlite3.Error as ex:
+            raise OSError(errno.EIO, 'Vocabulary error: {}'.format(ex))
+        finally:
+            db.close()
+        debug('Refreshed vocabulary for {}: {} tags'.format(root, len(counts)))
+
+    def save(self):
+        """ Apply tag changes from update() to every root that contains
+            the changed files.
+            Raises OSError on database errors.
+        """
+        with self.lock:
+            deltas, self.deltas = self.deltas, {}
+        if not deltas:
+            return None
+        db = self._connect()
+        if db is None:
+            return None
+        try:
+            with db:
+                roots = [
+                    root for root, in db.execute('SELECT root FROM roots')
+                ]
+                changes = {root: Counter() for root in roots}
+                for dirpath, delta in deltas.items():
+                    dirpath = os.path.realpath(dirpath)
+                    for root in roots:
+                        if self._contains(root, dirpath):
+                            changes[root].update(delta)
+                for root, delta in changes.items():
+                    for tag, cnt in delta.items():
+                        if not cnt:
+                            continue
+                        db.execute(
+                            '''INSERT OR IGNORE INTO vocabulary
+                                (root, tag, count) VALUES (?, ?, 0)''',
+                            (root, tag))
+                        db.execute(
+                            '''UPDATE vocabulary SET count = count + ?
+                                WHERE root = ? AND tag = ?''',
+                            (cnt, root, tag))
+                    db.execute(
+                        '''DELETE FROM vocabulary
+                            WHERE root = ? AND count <= 0''',
+                        (root, ))
+                self.export(db)
+        except sqlite3.Error as ex:
+            raise OSError(errno.EIO, 'Vocabulary error: {}'.format(ex))
+        finally:
+            db.close()
+        debug('Updated vocabulary for {} directories.'.format(len(deltas)))
+        return None
+
+    def update(self, path, oldtags, newtags):
+        """ Collect a change in tags for a file, for save(). """
+        oldtags, newtags = set(oldtags), set(newtags)
+        if oldtags == newtags:
+            return None
+        dirpath = os.path.dirname(path)
+        with self.lock:
+            delta = self.deltas.setdefault(dirpath, Counter())
+            delta.update(newtags - oldtags)
+            delta.subtract(oldtags - newtags)
+        return None
+
+
 class Editor(object):
     """ Holds information and helper methods for a single file and it's
         tags/comments.
@@ -749,8 +4118,22 @@ class Editor(object):
         The default attributes are 'user.xdg.tags' and
         'user.xdg.comment', but they can also be changed by setting
         Editor.attr_tags and Editor.attr_comment.
+        When tags are changed, any directory rollups above the file are
+        updated, one file at a time (with Editor.rollup_lock). Set
+        Editor.maintain_rollups to False to disable this.
+        If Editor.empty_cache is set to an EmptyCache, files without tags or
+        a comment are added to it.
+        If Editor.inode_cache is set to an InodeCache, attributes for files
+        with several names are only read once, and written once. Later
+        names read the value from before the write, so they report the same
+        change as the first name.
         Finally, if you would like xattr to follow symlinks then set
         Editor.follow_symlinks to True.
+        Paths are resolved with Editor.resolver, which can be set to a
+        PathResolver with a different mode.
+        Attributes are read and written with Editor.store, which can be set
+        to a SidecarStore or MirrorStore for file systems without extended
+        attribute support.
 
         If you would like AttrError to be raised for missing attributes,
         set Editor.errno_nodata to 0, or some other non-existent number in the
@@ -766,14 +4149,44 @@ class Editor(object):
     # Attributes to use for retrieving tags/comments.
     attr_tags = 'user.xdg.tags'
     attr_comment = 'user.xdg.comment'
+    # Attribute for directory tag rollups (tag counts for all sub-paths).
+    attr_rollup = 'user.filetags.rollup'
+    # Whether to update parent directory rollups when tags change.
+    maintain_rollups = True
+    # Rollups are read, changed, and written for each parent directory, so
+    # files changed from several threads must update them one at a time.
+    rollup_lock = threading.Lock()
+    # Largest rollup value, in bytes. Extended attribute values must fit in
+    # one file system block on ext4 (usually 4096 bytes, with the name).
+    rollup_max_size = 3900
+    # EmptyCache to add files with no tags or comment to.
+    empty_cache = None
+    # InodeCache for files with several names.
+    inode_cache = None
+    # Vocabulary to update when tags change.
+    vocabulary = None
     # Encoding to use when setting attribute values.
     encoding = sys.getdefaultencoding()
     # OSError number for no data available (attribute not available)
     errno_nodata = errno.ENODATA
     # Overridable separation character for tags when setting/parsing tags.
     tag_sep = ','
+    # Case folding and unicode normalization for matching and duplicate
+    # tags, set with set_folding().
+    folding = False
+    fold_case = False
+    fold_form = None
+    # Fold keys for tags shared by all files, {string: fold key}.
+    fold_keys = {}
+    # Maximum number of fold keys to keep. Once full, new keys are still
+    # computed but not kept.
+    fold_keys_max = 100000
     # Whether xattr should follow symlinks.
     follow_symlinks = False
+    # PathResolver used to resolve file paths.
+    resolver = PathResolver()
+    # Attribute storage (extended attributes, or a sidecar database).
+    store = XattrStore()
 
     class AttrError(EnvironmentError):
         """ Wrapper for EnvironmentError that is raised when getting, setting,
@@ -788,6 +4201,9 @@ class Editor(object):
         """
         self.tags = []
         self.comment = ''
+        # Folded tags, and the tags they were folded from.
+        self.fold_tags = []
+        self.fold_tags_src = []
         try:
             self.path = self._get_path(path)
         except (FileNotFoundError, ValueError):
@@ -795,8 +4211,65 @@ class Editor(object):
         else:
             # Only possible with a valid (resolved) path.
             self.filepath = str(self.path)
+            if METRICS is not None:
+                METRICS.count('scanned')
+            # Key for Editor.inode_cache, if this file is cached.
+            self.inode = None
+            # Attribute names written through this Editor.
+            self.written_attrs = set()
+            if self.inode_cache is not None:
+                self.inode = self.inode_cache.key(path, self.filepath)
             self.tags = self.get_tags()
             self.comment = self.get_comment()
+            # Tags that were last read or written, for updating rollups.
+            self.saved_tags = list(self.tags)
+            if (self.empty_cache is not None) and not (
+                    self.tags or self.comment):
+                self.empty_cache.add(self.filepath)
+
+    @classmethod
+    def _compile_repat(cls, repat, ignorecase=False):
+        """ Return `repat` ready for matching. A str pattern is compiled
+            (and folded, when folding is enabled), like the `re` module
+            accepts them. Compiled regexes and PatternSets are used as-is.
+            Raises ValueError if `ignorecase` is used with a PatternSet,
+            because it can't be recompiled.
+        """
+        if isinstance(repat, PatternSet):
+            if ignorecase:
+                raise ValueError(
+                    'ignorecase can\'t be used with a PatternSet: {}'.format(
+                        repat.pattern))
+            return repat
+        reflags = re.IGNORECASE if ignorecase else 0
+        if isinstance(repat, str):
+            if cls.folding:
+                repat = cls.fold_pattern(repat)
+            return re.compile(repat, reflags)
+        if ignorecase:
+            return re.compile(repat.pattern, repat.flags | reflags)
+        return repat
+
+    def _get_attr(self, attrname):
+        """ Retrieve a raw attribute value by name, without the inode cache.
+        """
+        try:
+            tagval = self.store.getxattr(
+                self.filepath,
+                attrname,
+                symlink=self.follow_symlinks)
+        except EnvironmentError as ex:
+            if ex.errno == self.errno_nodata:
+                # No data available.
+                return None
+            # Unexpected error.
+            raise self.AttrError(
+                'Unable to retrieve \'{}\' for: {}\n{}'.format(
+                    attrname,
+                    self.filepath,
+                    ex))
+
+        return tagval.decode()
 
     def _get_path(self, path):
         """ Resolve and return `path` if given, otherwise return `self.path`.
@@ -804,14 +4277,23 @@ class Editor(object):
             Also possibly raises FileNotFoundError when resolving `path`.
         """
         if path:
-            if isinstance(path, Path):
-                self.path = path.resolve()
-            elif isinstance(path, str):
-                self.path = Path(path).resolve()
+            if isinstance(path, (Path, str)):
+                self.path = Path(self.resolver.resolve(str(path)))
         if self.path:
             return self.path
         raise ValueError('No path set for this EditFile instance.')
 
+    def _tags_changed(self, taglist):
+        """ Update directory rollups and the vocabulary after the tags
+            attribute was set to `taglist`, or removed.
+        """
+        if self.maintain_rollups:
+            with self.rollup_lock:
+                update_rollups(self.filepath, self.saved_tags, taglist)
+        if self.vocabulary is not None:
+            self.vocabulary.update(self.filepath, self.saved_tags, taglist)
+        self.saved_tags = list(taglist)
+
     def add_tag(self, tag):
         """ Add a single tag to the tags for this file.
             Duplicate tags will not be added.
@@ -821,7 +4303,7 @@ class Editor(object):
         """
         if not tag:
             raise ValueError('Empty tags may not be added: {!r}'.format(tag))
-        if tag in self.tags:
+        if self.fold_key(tag) in self.get_fold_tags():
             return self.tags
         self.tags.append(tag)
         return self.set_tags(self.tags)
@@ -853,25 +4335,55 @@ class Editor(object):
         """
         return self.remove_attr(self.attr_tags)
 
+    @classmethod
+    def fold_key(cls, s, cache=True):
+        """ Return the folded form of `s` used for matching, when case
+            folding or unicode normalization is enabled, otherwise `s`.
+            Keys are computed once for each string, up to fold_keys_max
+            strings. Use `cache=False` for strings that are unlikely to
+            repeat, like comments.
+        """
+        if not cls.folding:
+            return s
+        key = cls.fold_keys.get(s, None) if cache else None
+        if key is None:
+            key = s
+            if cls.fold_form:
+                key = unicodedata.normalize(cls.fold_form, key)
+            if cls.fold_case:
+                key = key.casefold()
+                if cls.fold_form:
+                    # Case folding can undo normalization.
+                    key = unicodedata.normalize(cls.fold_form, key)
+            if cache and (len(cls.fold_keys) < cls.fold_keys_max):
+                cls.fold_keys[s] = key
+        return key
+
+    @classmethod
+    def fold_pattern(cls, pattern):
+        """ Return a regex pattern folded like fold_key(), so it matches
+            folded strings. Escaped characters (like \\S or \\W) are
+            not folded.
+        """
+        # Odd indexes are escapes.
+        pieces = re.split(r'(\\.)', pattern, flags=re.DOTALL)
+        return ''.join(
+            piece if i % 2 else cls.fold_key(piece)
+            for i, piece in enumerate(pieces))
+
     def get_attr(self, attrname):
         """ Retrieve a raw attribute value by name. """
-        try:
-            tagval = xattr.getxattr(
-                self.filepath,
+        if self.inode is not None:
+            found, value = self.inode_cache.get(
+                self.inode,
                 attrname,
-                symlink=self.follow_symlinks)
-        except EnvironmentError as ex:
-            if ex.errno == self.errno_nodata:
-                # No data available.
-                return None
-            # Unexpected error.
-            raise self.AttrError(
-                'Unable to retrieve \'{}\' for: {}\n{}'.format(
-                    attrname,
-                    self.filepath,
-                    ex))
-
-        return tagval.decode()
+                original=attrname not in self.written_attrs)
+            if found:
+                return value
+            value = self._get_attr(attrname)
+            self.inode_cache.set(self.inode, attrname, value)
+            return value
+        return self._get_attr(attrname)
 
     def get_attrs(self):
         """ Return a dict of {attr: value} for all extended attributes for
@@ -879,7 +4391,7 @@ class Editor(object):
             Possibly raises AttrError.
         """
         try:
-            attrs = xattr.listxattr(
+            attrs = self.store.listxattr(
                 self.filepath,
                 symlink=self.follow_symlinks)
         except EnvironmentError as ex:
@@ -905,6 +4417,17 @@ class Editor(object):
             return ''
         return comment.strip()
 
+    def get_fold_tags(self):
+        """ Return folded tags for this file (see fold_key()), only folding
+            them again when the tags have changed.
+        """
+        if not self.folding:
+            return self.tags
+        if self.fold_tags_src != self.tags:
+            self.fold_tags_src = list(self.tags)
+            self.fold_tags = [self.fold_key(tag) for tag in self.tags]
+        return self.fold_tags
+
     def get_tags(self, refresh=False):
         """ Return sorted tags for this file.
             If self.tags is already set, return it.
@@ -922,14 +4445,17 @@ class Editor(object):
             comment.
             If `reverse` is used, returns the comment if the pattern does not
             match.
+            `repat` may be a str, a compiled regex, or a PatternSet.
             Returns None on non-matches.
+            Raises ValueError if `ignorecase` is used with a PatternSet.
         """
         self.comment = self.get_comment()
-        reflags = re.IGNORECASE if ignorecase else 0
+        repat = self._compile_repat(repat, ignorecase=ignorecase)
+        comment = self.fold_key(self.comment, cache=False)
         if reverse:
-            matched = re.search(repat, self.comment, reflags) is None
+            matched = repat.search(comment) is None
         else:
-            matched = re.search(repat, self.comment, reflags) is not None
+            matched = repat.search(comment) is not None
         if matched:
             return self.comment
         return None
@@ -939,35 +4465,51 @@ class Editor(object):
             tags.
             If `reverse` is used, returns the tag list if none of the tags
             match.
+            When folding is enabled, the folded tags are matched, and
+            `repat` should be folded too (see try_repat()). A str pattern
+            is folded and compiled here.
             Returns None on non-matches.
+            Raises ValueError if `ignorecase` is used with a PatternSet.
         """
         self.tags = self.get_tags()
-        reflags = re.IGNORECASE if ignorecase else 0
+        repat = self._compile_repat(repat, ignorecase=ignorecase)
         if reverse:
             def ismatch(s):
-                return re.search(repat, s, reflags) is None
+                return repat.search(s) is None
             # All tags must not match.
             boolfilter = all
         else:
             def ismatch(s):
-                return re.search(repat, s, reflags) is not None
+                return repat.search(s) is not None
             # Any tag may match.
             boolfilter = any
         if not self.tags:
             # Empty tags. Patterns will test against an empty string.
             return [] if ismatch('') else None
 
-        if boolfilter(ismatch(s) for s in self.tags):
+        if boolfilter(ismatch(s) for s in self.get_fold_tags()):
             return self.tags
 
         return None
 
+    @classmethod
+    def normalize_tag(cls, tag):
+        """ Return a normalized tag, lowercase with no extra whitespace. """
+        return ' '.join(tag.split()).lower()
+
     @classmethod
     def parse_taglist(cls, taglist):
         """ Parse a tag list into a attribute-friendly string.
             Sorts and removes duplicates.
+            When folding is enabled, tags with the same fold key are
+            duplicates, and the first one is kept.
         """
-        return cls.tag_sep.join(sorted(set(taglist)))
+        if not cls.folding:
+            return cls.tag_sep.join(sorted(set(taglist)))
+        unique = {}
+        for tag in taglist:
+            unique.setdefault(cls.fold_key(tag), tag)
+        return cls.tag_sep.join(sorted(unique.values()))
 
     @classmethod
     def parse_tagstr(cls, tagstr):
@@ -989,8 +4531,15 @@ class Editor(object):
             Returns True on success.
             Possibly raises AttrError.
         """
+        if self.inode is not None:
+            if self.inode_cache.was_written(self.inode, attrname):
+                # Already changed through another name for this file.
+                self.written_attrs.add(attrname)
+                if attrname == self.attr_tags:
+                    self._tags_changed([])
+                return True
         try:
-            xattr.removexattr(
+            self.store.removexattr(
                 self.filepath,
                 attrname,
                 symlink=self.follow_symlinks)
@@ -1003,6 +4552,13 @@ class Editor(object):
                     attrname,
                     self.filepath,
                     ex))
+        if self.inode is not None:
+            self.inode_cache.set(self.inode, attrname, None, written=True)
+            self.written_attrs.add(attrname)
+        if METRICS is not None:
+            METRICS.count('written')
+        if attrname == self.attr_tags:
+            self._tags_changed([])
         return True
 
     def remove_comment(self):
@@ -1019,26 +4575,46 @@ class Editor(object):
             Does not care if the tag isn't present.
             Possibly raises AttrError.
         """
-        try:
-            self.tags.remove(tag)
-        except ValueError:
-            pass
-        newtagstr = self.set_tags(self.tags)
-        return self.parse_tagstr(newtagstr)
+        return self.remove_tags([tag])
 
     def remove_tags(self, taglist):
         """ Remove multiple tags at once from this file.
             Returns any tags that are left as a list.
             Does not care if one of the tags isn't present.
+            When folding is enabled, tags with the same fold key are removed.
             Possibly raises AttrError.
         """
-        for t in taglist:
-            try:
-                self.tags.remove(t)
-            except ValueError:
-                pass
-        newtagstr = self.set_tags(self.tags)
-        return self.parse_tagstr(newtagstr)
+        removekeys = {self.fold_key(t) for t in taglist}
+        self.tags = [
+            t for t in self.tags
+            if self.fold_key(t) not in removekeys
+        ]
+        return self.set_tags(self.tags)
+
+    def rename_tags(self, renames, normalize=False):
+        """ Rename tags for this file using a dict of {old: new}.
+            Renaming to an existing tag merges them, and renaming to '' removes
+            the tag. If `normalize` is truthy, tags are normalized before
+            renaming.
+            Tags are only written if they changed.
+            Returns the new tags as a list.
+            Possibly raises AttrError.
+        """
+        newtags = []
+        for tag in self.tags:
+            if normalize:
+                tag = self.normalize_tag(tag)
+            tag = renames.get(tag, tag)
+            if tag:
+                newtags.append(tag)
+        newtags = sorted(set(newtags))
+        if newtags == self.tags:
+            return self.tags
+        if not newtags:
+            self.clear_tags()
+            self.tags = []
+            return self.tags
+        return self.set_tags(newtags)
 
     def set_attr(self, attrname, value):
         """ Set the value for a raw attribute.
@@ -1056,8 +4632,14 @@ class Editor(object):
                 'Expecting str or bytes. Got: {} ({})'.format(
                     getattr(valtype, '__name__', valtype),
                     value))
+        if self.inode is not None:
+            if self.inode_cache.was_written(self.inode, attrname):
+                # Already changed through another name for this file.
+                self.written_attrs.add(attrname)
+                _, cached = self.inode_cache.get(self.inode, attrname)
+                return cached or ''
         try:
-            xattr.setxattr(
+            self.store.setxattr(
                 self.filepath,
                 attrname,
                 encodedvalue,
@@ -1068,7 +4650,15 @@ class Editor(object):
                     attrname,
                     self.filepath,
                     ex))
-
+        if self.inode is not None:
+            self.inode_cache.set(
+                self.inode,
+                attrname,
+                encodedvalue.decode(),
+                written=True)
+            self.written_attrs.add(attrname)
+        if METRICS is not None:
+            METRICS.count('written')
         return value
 
     def set_comment(self, text):
@@ -1079,6 +4669,24 @@ class Editor(object):
         self.comment = self.set_attr(self.attr_comment, text)
         return self.comment
 
+    @classmethod
+    def set_folding(cls, ignorecase=False, form=None):
+        """ Enable case folding (`ignorecase`) and/or unicode normalization
+            (`form`: NFC, NFD, NFKC, or NFKD) for matching and duplicate
+            tags.
+            Raises ValueError for invalid forms.
+        """
+        if form:
+            form = form.upper()
+            if form not in ('NFC', 'NFD', 'NFKC', 'NFKD'):
+                raise ValueError(
+                    'Invalid unicode form, expecting one of: '
+                    'NFC, NFD, NFKC, NFKD')
+        cls.fold_case = bool(ignorecase)
+        cls.fold_form = form or None
+        cls.folding = cls.fold_case or bool(cls.fold_form)
+        cls.fold_keys = {}
+
     def set_tags(self, taglist):
         """ Set the tags for this file.
             `taglist` should be an iterable of strings (tags).
@@ -1089,6 +4697,7 @@ class Editor(object):
         tagstr = self.parse_taglist(taglist)
         newvalue = self.set_attr(self.attr_tags, tagstr)
         self.tags = self.parse_tagstr(newvalue)
+        self._tags_changed(self.tags)
         return self.tags
 
 
@@ -1096,6 +4705,10 @@ if __name__ == '__main__':
     ARGD = docopt(USAGESTR, version=VERSIONSTR, script=SCRIPT)
     DEBUG = ARGD['--debug']
     QUIET = ARGD['--quiet']
+    if ARGD['--progress'] or ARGD['--metrics-file']:
+        METRICS = Metrics(
+            progress=ARGD['--progress'],
+            filepath=ARGD['--metrics-file'])
     if ARGD['--nocolor']:
         # Override automatic detection.
         colr_disable()